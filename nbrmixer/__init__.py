@@ -1,4 +1,39 @@
+"""
+The submodules other than files are imported when first used, so a script
+that only needs file names does not pay for importing nsim, nbrsim, fitsio
+and esutil.  Python before 3.7 has no module __getattr__, so they are
+imported up front as before.
+"""
+import sys
+import importlib
+
 from . import files
-from . import scripts
-from . import averaging
-from . import util
+
+_submodules = [
+    'scripts',
+    'averaging',
+    'util',
+    'matching',
+    'collate',
+    'sums',
+    'status',
+    'local',
+    'chunking',
+    'splits',
+    'columnar',
+]
+
+if sys.version_info >= (3,7):
+    def __getattr__(name):
+        if name in _submodules:
+            return importlib.import_module('.'+name, __name__)
+
+        raise AttributeError(
+            "module '%s' has no attribute '%s'" % (__name__, name)
+        )
+
+    def __dir__():
+        return sorted(list(globals().keys()) + _submodules)
+else:
+    for _name in _submodules:
+        importlib.import_module('.'+_name, __name__)
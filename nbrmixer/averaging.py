@@ -5,13 +5,18 @@ except:
     xrange=range
 
 import os
-import shutil
 import numpy
+import fitsio
 import nsim
 import nbrsim
 
 from . import files
 from . import util
+from . import selection
+from . import cache
+from . import columnar
+from . import collate
+from .sums import add_sums
 
 
 class NbrmixerSummer(nsim.averaging_new.Summer):
@@ -47,25 +52,318 @@ class NbrmixerSummer(nsim.averaging_new.Summer):
 
 
 
-    def get_run_output(self, run):
+    def do_sums(self):
         """
-        collated file
+        do the sums for each run, reading the outputs in chunks
+
+        Only the columns needed for the sums are read if sum_columns is
+        set in the run config; see get_sum_columns
+
+        When multiple selections were sent, each chunk is read once and
+        the sums for all selections are accumulated together; a dict of
+        sums keyed by select name is returned and a sums file is written
+        for each selection
+        """
+        args=self.args
+
+        allsums={}
+        for name in self.select_names:
+            allsums[name] = None
+
+        for run in self.runs:
+
+            todo=[]
+            for name in self.select_names:
+                sums_file=self._get_select_sums_file(run, name)
+
+                if os.path.exists(sums_file) and not args.force:
+                    print("reading sums:",sums_file)
+                    tsums=fitsio.read(sums_file)
+                    allsums[name]=add_sums(allsums[name], tsums)
+                else:
+                    todo.append(name)
+
+            if len(todo) == 0:
+                continue
+
+            rows=self.get_run_rows(run)
+            store=self.get_run_store(run, rows=rows)
+            if store is not None:
+                file_sums=self._do_store_sums(store, todo, rows=rows)
+            else:
+                fname=self.get_run_output(run, rows=rows)
+                if args.cache:
+                    file_sums=self._do_cached_file_sums(fname, todo, rows=rows)
+                else:
+                    file_sums=self._do_file_sums(fname, todo, rows=rows)
+
+            for name in todo:
+                tsums=file_sums[name]
+                if tsums is None:
+                    continue
+
+                sums_file=self._get_select_sums_file(run, name)
+                sums_dir=os.path.dirname(sums_file)
+                if not os.path.exists(sums_dir):
+                    os.makedirs(sums_dir)
+
+                print("writing sums:",sums_file)
+                fitsio.write(sums_file, tsums, clobber=True)
+
+                allsums[name]=add_sums(allsums[name], tsums)
+
+        if self.multi_select:
+            return allsums
+        else:
+            return allsums[self.select_names[0]]
+
+    def do_index_range(self, start, end):
+        """
+        do the sums for each output file in the range [start,end],
+        writing a sums file for each
+
+        returns
+        -------
+        failed: list
+            The indices that could not be processed
         """
+        return self.do_indices(list(xrange(start, end+1)))
+
+    def do_indices(self, indices):
+        """
+        do the sums for each output file in the list of indices,
+        writing a sums file for each
+
+        This is done in a single process, so the configuration and
+        selection are only loaded once
+
+        returns
+        -------
+        failed: list
+            The indices that could not be processed
+        """
+
+        failed=[]
+        for i,index in enumerate(indices):
+            print("index: %d (%d/%d)" % (index,i+1,len(indices)))
+            self.args.index=index
+
+            try:
+                self.do_sums()
+            except (IOError, ValueError) as err:
+                print("could not process index %d: %s" % (index, err))
+                failed.append(index)
+
+        self.args.index=None
+
+        if len(failed) > 0:
+            print("%d/%d failed" % (len(failed), len(indices)))
+
+        return failed
+
+    def _do_file_sums(self, fname, select_names, rows=None):
+        """
+        do the sums for a single file, reading in chunks
+
+        parameters
+        ----------
+        fname: string
+            The file to read
+        select_names: list
+            The selections
+        rows: tuple, optional
+            Only use rows [beg,end) of the file
+
+        returns
+        -------
+        sums: dict
+            sums keyed by select name
+        """
+
+        print("reading:",fname)
+        with fitsio.FITS(fname) as fits:
+            hdu=fits[1]
+            columns=self.get_sum_columns(hdu.get_colnames())
+
+            if rows is None:
+                rows = (0, hdu.get_nrows())
+
+            def reader(columns, beg, end):
+                if columns is None:
+                    return hdu[beg:end]
+                return hdu[columns][beg:end]
+
+            return self._do_chunked_sums(
+                reader,
+                columns,
+                rows,
+                select_names,
+            )
+
+    def _do_cached_file_sums(self, fname, select_names, rows=None):
+        """
+        do the sums from a copy of the file in the local disk cache,
+        holding a reference so the copy is not evicted while it is read
+        """
+        dcache = cache.DiskCache()
+        holder = os.getpid()
+
+        local_fname = dcache.acquire(fname, holder=holder)
+        try:
+            return self._do_file_sums(local_fname, select_names, rows=rows)
+        finally:
+            dcache.release(fname, holder=holder)
+
+    def _do_store_sums(self, store, select_names, rows=None):
+        """
+        do the sums from the memory mapped columns of the collated
+        file, in chunks, optionally only for rows [beg,end)
+
+        returns
+        -------
+        sums: dict
+            sums keyed by select name
+        """
+
+        print("reading columns:",store.dir)
+        columns=self.get_sum_columns(store.get_colnames())
+
+        if rows is None:
+            rows = (0, store.get_nrows())
+
+        return self._do_chunked_sums(
+            lambda columns, beg, end: store.read(columns=columns, beg=beg, end=end),
+            columns,
+            rows,
+            select_names,
+        )
+
+    def _do_chunked_sums(self, reader, columns, rows, select_names):
+        """
+        do the sums for rows [beg,end) read in chunks by
+        reader(columns, beg, end), with columns None to read all
+        """
+
+        args=self.args
+        chunksize=args.chunksize
+
+        sums={}
+        for name in select_names:
+            sums[name]=None
+
+        start, stop = rows
+        nrows = stop-start
+        nchunks = nrows//chunksize
+        if (nrows % chunksize) > 0:
+            nchunks += 1
 
+        ntot=0
+        for i in xrange(nchunks):
+            beg = start + i*chunksize
+            end = min(beg+chunksize, stop)
+            print("    chunk %d/%d" % (i+1,nchunks))
+
+            data = reader(columns, beg, end)
+            self._do_chunk_sums(data, select_names, sums)
+
+            ntot += data.size
+
+            if args.ntest is not None and ntot > args.ntest:
+                break
+
+        return sums
+
+    def _do_chunk_sums(self, data, select_names, sums):
+        """
+        add the sums for the chunk to the sums for each selection
+        """
+        if 'shear_true' not in data.dtype.names:
+            data=self._add_true_shear(data)
+
+        data=self._preselect(data)
+        for name in select_names:
+            self._use_select(name)
+            sums[name]=self.do_sums1(data, sums=sums[name])
+
+    def get_sum_columns(self, colnames):
+        """
+        get the columns to read for the sums, or None to read all of them
+
+        Only columns matching the sum_columns patterns in the run config
+        are read, which must cover all the fields used by do_sums1.  The
+        fields referenced in the select strings as data["field"] and the
+        columns for the options in use, e.g. --preselect, are added.
+        Without sum_columns all columns are read
+        """
+        if 'sum_columns' not in self:
+            return None
+
+        patterns = selection.parse_list(self['sum_columns'])
+        for name in sorted(self.select_fields):
+            patterns += self.select_fields[name].fields
+
+        patterns += selection.get_option_patterns(self.args)
+
+        return selection.match_columns(colnames, patterns)
+
+    def get_run_rows(self, run):
+        """
+        rows of the collated file for the index, if requested with
+        --from-collated and the index is in the collated file,
+        otherwise None
+        """
         if self.args.index is None:
+            return None
+
+        if not getattr(self.args, 'from_collated', False):
+            return None
+
+        # the index is read once per run, for use with multiple indices
+        if not hasattr(self, '_collated_indexes'):
+            self._collated_indexes={}
+        if run not in self._collated_indexes:
+            self._collated_indexes[run] = collate.read_index(run)
+
+        index = self._collated_indexes[run]
+        if index is None:
+            rows = None
+        else:
+            rows = collate.get_row_range(run, self.args.index, index=index)
+
+        if rows is None:
+            print("index %d not in the collated file index for %s, "
+                  "reading the output file" % (self.args.index, run))
+
+        return rows
+
+    def get_run_store(self, run, rows=None):
+        """
+        columnar copy of the collated file, if requested with --columnar
+        and it is up to date, otherwise None
+        """
+        if self.args.index is not None and rows is None:
+            return None
+
+        if not getattr(self.args, 'columnar', False):
+            return None
+
+        store = columnar.get_store(run)
+        if store is None:
+            print("no up to date columns for %s, reading the collated file" % run)
+
+        return store
+
+    def get_run_output(self, run, rows=None):
+        """
+        collated file, or the output file when doing a single index
+        that is not read from the collated file
+        """
+
+        if self.args.index is None or rows is not None:
             fname = files.get_collated_file(run)
         else:
             fname = files.get_output_file(run, self.args.index)
 
-        if self.args.cache:
-            origname=fname
-            bname = os.path.basename(origname)
-            fname=os.path.join('$TMPDIR', bname)
-            fname=os.path.expandvars(fname)
-            if not os.path.exists(fname):
-                print("copying to cache: %s -> %s" % (origname,fname))
-                shutil.copy(origname, fname)
-
         return fname
 
     def _add_true_shear(self, data):
@@ -105,16 +403,47 @@ class NbrmixerSummer(nsim.averaging_new.Summer):
 
 
     def _set_select(self):
+        """
+        load the selections.  The select argument can be a comma separated
+        list of select configs, in which case the sums are done for all of
+        them in a single pass
+        """
         self.select=None
         self.do_selection=False
 
+        self.selects={}
+        self.select_fields={}
+        self.select_names=[None]
+
         if self.args.select is not None:
             self.do_selection=True
 
-            d = files.read_config(self.args.select)
-            self.select = d['select'].strip()
+            self.select_names = selection.parse_list(self.args.select)
+            for name in self.select_names:
+                d = files.read_config(name)
+                self.selects[name] = d['select'].strip()
+                self.select_fields[name] = selection.parse_select(
+                    self.selects[name],
+                )
 
         elif self.args.weighted:
             self.do_selection=True
 
+        self._use_select(self.select_names[0])
+
+        self.multi_select = len(self.select_names) > 1
 
+    def _use_select(self, name):
+        """
+        make the named selection the current one
+        """
+        if name is not None:
+            self.args.select=name
+            self.select=self.selects[name]
+
+    def _get_select_sums_file(self, run, name):
+        """
+        the sums file for the run and named selection
+        """
+        self._use_select(name)
+        return self._get_sums_file(run)
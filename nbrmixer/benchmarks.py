@@ -0,0 +1,215 @@
+"""
+simple timing benchmarks
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import subprocess
+import numpy
+
+# modules that are slow to import, reported by bench_imports
+HEAVY_MODULES=['numpy','fitsio','esutil','yaml','nsim','nbrsim','ngmix']
+
+# run in a fresh interpreter to time the import of a module, or of a script
+# run with --help, which exits after the imports and argument parsing.  The
+# nbrmixer submodules a script uses are imported after, since the lazy
+# imports in the package would otherwise only happen in main()
+_import_code = r"""
+import sys, time, json, importlib
+heavy = %(heavy)s
+target = %(target)r
+uses = %(uses)r
+tm0 = time.time()
+stdout = sys.stdout
+sys.stdout = sys.stderr
+error = None
+try:
+    if %(is_script)r:
+        import runpy
+        sys.argv = [target, '--help']
+        try:
+            runpy.run_path(target, run_name='__main__')
+        except SystemExit:
+            pass
+        for name in uses:
+            importlib.import_module(name)
+    else:
+        importlib.import_module(target)
+except Exception as err:
+    error = '%%s: %%s' %% (err.__class__.__name__, err)
+sys.stdout = stdout
+print(json.dumps({
+    'time': time.time()-tm0,
+    'loaded': [m for m in heavy if m in sys.modules],
+    'error': error,
+}))
+"""
+
+
+def bench_match(ntruth=20000, size=10000.0, ndet=None, radius=8.0,
+                allow=1, seed=None, legacy=True):
+    """
+    compare the array based matcher to the original loop
+
+    A tile of random truth positions is generated and detections are
+    placed near a subset of them, with a small scatter.
+
+    parameters
+    ----------
+    ntruth: int
+        Number of truth objects
+    size: float
+        Size of the square tile in pixels
+    ndet: int, optional
+        Number of detections, default 0.8*ntruth
+    radius: float
+        Match radius in pixels
+    allow: int
+        Max number of matches per detection
+    seed: int, optional
+        Seed for the random number generator
+    legacy: bool
+        If True, also time the original loop and check the results agree
+
+    returns
+    -------
+    times: dict
+        The times for each method in seconds
+    """
+    from . import matching
+    from . import util
+
+    rng=numpy.random.RandomState(seed)
+
+    if ndet is None:
+        ndet = int(0.8*ntruth)
+
+    xt = rng.uniform(low=0, high=size, size=ntruth)
+    yt = rng.uniform(low=0, high=size, size=ntruth)
+
+    ind = rng.randint(0, ntruth, size=ndet)
+    xd = xt[ind] + rng.normal(scale=radius/2.0, size=ndet)
+    yd = yt[ind] + rng.normal(scale=radius/2.0, size=ndet)
+
+    print("ntruth: %d ndet: %d radius: %g allow: %d" % (ntruth,ndet,radius,allow))
+
+    times={}
+
+    tm0=time.time()
+    m1, m2 = matching.close_match(xd, yd, xt, yt, radius, allow)
+    times['array'] = time.time()-tm0
+    print("    array:  %.3f sec  %d matches" % (times['array'], m1.size))
+
+    if legacy:
+        tm0=time.time()
+        lm1, lm2 = util.close_match(xd, yd, xt, yt, radius, allow)
+        times['legacy'] = time.time()-tm0
+        print("    legacy: %.3f sec  %d matches" % (times['legacy'], lm1.size))
+
+        print("    speedup: %.1f" % (times['legacy']/times['array']))
+
+        pairs = set(zip(m1.tolist(), m2.tolist()))
+        lpairs = set(zip(lm1.tolist(), lm2.tolist()))
+        ndiff = len(pairs.symmetric_difference(lpairs))
+        print("    pairs differing: %d" % ndiff)
+        times['ndiff'] = ndiff
+
+    return times
+
+def bench_imports(scripts=None, modules=None, nrepeat=3):
+    """
+    time the startup cost of the scripts and modules, each in a fresh
+    interpreter, and report which heavy modules they load
+
+    The scripts are run with --help, so only the imports and argument
+    parsing are timed, and then the nbrmixer submodules named in the script
+    are imported, as main() would.  The best of nrepeat runs is reported, with the
+    time for an empty interpreter subtracted
+
+    parameters
+    ----------
+    scripts: list, optional
+        Paths to the scripts
+    modules: list, optional
+        Module names, default nbrmixer and its files module
+    nrepeat: int
+        Number of times to run each
+
+    returns
+    -------
+    times: dict
+        Keyed by script or module, with entries time, loaded and error
+    """
+
+    if scripts is None:
+        scripts=[]
+    if modules is None:
+        modules=['nbrmixer','nbrmixer.files']
+
+    base = min([_time_command([sys.executable,'-c','pass'])
+                for i in range(nrepeat)])
+    print("interpreter startup: %.3f sec" % base)
+
+    targets = [(m,False) for m in modules] + [(s,True) for s in scripts]
+
+    times={}
+    for target, is_script in targets:
+        code = _import_code % {
+            'heavy': repr(HEAVY_MODULES),
+            'target': target,
+            'is_script': is_script,
+            'uses': _get_script_uses(target) if is_script else [],
+        }
+
+        best=None
+        for i in range(nrepeat):
+            tm0=time.time()
+            with open(os.devnull,'w') as devnull:
+                output = subprocess.check_output(
+                    [sys.executable,'-c',code],
+                    stderr=devnull,
+                )
+            tm = time.time()-tm0-base
+
+            res = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+            if best is None or tm < best['time']:
+                res['time'] = tm
+                best = res
+
+        name = os.path.basename(target) if is_script else target
+        print("    %-28s %.3f sec  loads: %s" % (
+            name, best['time'], ' '.join(best['loaded']),
+        ))
+        if best['error'] is not None:
+            print("        error: %s" % best['error'])
+
+        times[name] = best
+
+    return times
+
+def _get_script_uses(script):
+    """
+    get the nbrmixer submodules named in the script source
+    """
+    import re
+
+    with open(script) as fobj:
+        text=fobj.read()
+
+    names=set(re.findall(r'nbrmixer\.(\w+)', text))
+    for imports in re.findall(r'from\s+nbrmixer\s+import\s+([\w, ]+)', text):
+        names.update(n.strip() for n in imports.split(','))
+
+    # only names that are modules in the package
+    pkgdir=os.path.dirname(os.path.abspath(__file__))
+    return [
+        'nbrmixer.%s' % n for n in sorted(names)
+        if os.path.exists(os.path.join(pkgdir, n+'.py'))
+    ]
+
+def _time_command(command):
+    tm0=time.time()
+    subprocess.check_call(command)
+    return time.time()-tm0
@@ -0,0 +1,407 @@
+"""
+local disk cache for input files
+
+Files are copied into the cache directory under a lock for that file, so
+concurrent jobs on a node share a single copy, while copies of different
+files proceed in parallel.  A lock for the whole cache is only held while
+updating references and evicting.  Copies are written to a temporary name
+and renamed into place, so a partial copy is never seen.
+
+A cached copy keeps the mtime of the source, and is only used if its size
+and mtime match the source.  The access time is updated on each use, and
+the least recently used files are removed when the cache would exceed
+its byte budget.
+
+Jobs that stage files with acquire hold a reference until they call
+release, and referenced files are never evicted.  The references record
+the host and pid of the holder, so those left by jobs that died are
+dropped.
+"""
+from __future__ import print_function
+import os
+import time
+import json
+import errno
+import shutil
+import socket
+import fcntl
+import hashlib
+
+from . import files
+
+# default budget in GB when $NBRMIXER_CACHE_MAX_GB is not set
+DEFAULT_MAX_GB=100.0
+
+LOCK_NAME='.lock'
+LOCK_SUFFIX='.lock'
+TMP_SUFFIX='.tmp'
+REFS_SUFFIX='.refs'
+
+
+class DiskCache(object):
+    """
+    a local disk cache with a byte budget and LRU eviction
+
+    parameters
+    ----------
+    dir: string, optional
+        The cache directory.  Default is from files.get_cache_dir()
+    max_bytes: int, optional
+        Maximum total size of the cached files.  Default is from
+        $NBRMIXER_CACHE_MAX_GB, or DEFAULT_MAX_GB
+    """
+    def __init__(self, dir=None, max_bytes=None):
+        if dir is None:
+            dir=files.get_cache_dir()
+
+        if max_bytes is None:
+            max_gb=float(os.environ.get('NBRMIXER_CACHE_MAX_GB',DEFAULT_MAX_GB))
+            max_bytes=int(max_gb*1024**3)
+
+        self.dir=dir
+        self.max_bytes=max_bytes
+
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                # another process may have made it
+                if not os.path.isdir(self.dir):
+                    raise
+
+    def get(self, fname):
+        """
+        get the local path for the file, copying it into the cache if
+        needed
+
+        parameters
+        ----------
+        fname: string
+            path to the source file
+
+        returns
+        -------
+        local_fname: string
+            path to the cached copy
+        """
+
+        return self._stage(fname)
+
+    def acquire(self, fname, holder=None):
+        """
+        get the local path for the file, copying it into the cache if
+        needed, and add a reference so it is not evicted until released
+
+        parameters
+        ----------
+        fname: string
+            path to the source file
+        holder: int, optional
+            pid of the process holding the reference, e.g. the job
+            script.  Default is the parent of this process
+
+        returns
+        -------
+        local_fname: string
+            path to the cached copy
+        """
+
+        if holder is None:
+            holder=os.getppid()
+
+        return self._stage(fname, ref=_get_ref(holder))
+
+    def release(self, fname, holder=None):
+        """
+        drop a reference to the cached copy, which may then be evicted
+
+        parameters
+        ----------
+        fname: string
+            path to the source file
+        holder: int, optional
+            pid of the process holding the reference.  Default is the
+            parent of this process
+        """
+
+        if holder is None:
+            holder=os.getppid()
+
+        ref = _get_ref(holder)
+        with self._lock():
+            local_fname = self.get_local_path(fname)
+            refs = self._read_refs(local_fname)
+            if ref in refs:
+                refs.remove(ref)
+            else:
+                print("warning: no reference to %s held by %s" % (fname, ref))
+
+            self._write_refs(local_fname, refs)
+
+    def get_refcount(self, local_fname):
+        """
+        number of live references to the cached file
+        """
+        return len(self._read_refs(local_fname))
+
+    def get_local_path(self, fname):
+        """
+        path for the cached copy of the file
+
+        The name includes a hash of the source directory, so files with
+        the same name from different directories do not collide
+        """
+        fname = os.path.abspath(fname)
+        dir, bname = os.path.split(fname)
+
+        dhash = hashlib.md5(dir.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.dir, '%s-%s' % (dhash, bname))
+
+    def remove(self, fname):
+        """
+        remove the cached copy of the file, if present
+        """
+        with self._lock():
+            local_fname = self.get_local_path(fname)
+            if self.get_refcount(local_fname) > 0:
+                print("not removing referenced file:",local_fname)
+                return
+
+            self._remove_entry(local_fname)
+
+    def get_entries(self):
+        """
+        get a list of (path, size, atime) for the cached files
+        """
+        entries=[]
+        for name in os.listdir(self.dir):
+            if (name == LOCK_NAME
+                    or name.endswith(LOCK_SUFFIX)
+                    or name.endswith(TMP_SUFFIX)
+                    or name.endswith(REFS_SUFFIX)):
+                continue
+
+            path=os.path.join(self.dir, name)
+            try:
+                st=os.stat(path)
+            except OSError:
+                continue
+
+            entries.append( (path, st.st_size, st.st_atime) )
+
+        return entries
+
+    def _stage(self, fname, ref=None):
+        """
+        copy the file into the cache if needed, adding the reference if
+        sent
+
+        The copy is done holding only the lock for this file, so jobs
+        staging other files are not blocked.  The reference is added before
+        copying, so the new copy cannot be evicted before it is used.
+        Copies of different files made at the same time can briefly take
+        the cache over its budget
+        """
+        local_fname = self.get_local_path(fname)
+        st = os.stat(fname)
+
+        with self._file_lock(local_fname):
+            with self._lock():
+                if ref is not None:
+                    self._add_ref(local_fname, ref)
+
+                valid = self._is_valid(local_fname, st)
+                if valid:
+                    self._touch(local_fname, st)
+                else:
+                    self._make_room(st.st_size, keep=local_fname)
+
+            if not valid:
+                try:
+                    self._copy(fname, local_fname, st)
+                except:
+                    if ref is not None:
+                        with self._lock():
+                            self._remove_ref(local_fname, ref)
+                    raise
+
+        return local_fname
+
+    def _add_ref(self, local_fname, ref):
+        refs = self._read_refs(local_fname)
+        refs.append(ref)
+        self._write_refs(local_fname, refs)
+
+    def _remove_ref(self, local_fname, ref):
+        refs = self._read_refs(local_fname)
+        if ref in refs:
+            refs.remove(ref)
+        self._write_refs(local_fname, refs)
+
+    def _is_valid(self, local_fname, st):
+        """
+        check the cached copy exists and matches the source size
+        and mtime
+        """
+        try:
+            lst = os.stat(local_fname)
+        except OSError:
+            return False
+
+        return lst.st_size == st.st_size and lst.st_mtime == st.st_mtime
+
+    def _make_room(self, nbytes, keep=None):
+        """
+        remove the least recently used files until nbytes more
+        will fit in the budget
+
+        Files with references are not removed
+        """
+
+        entries = [e for e in self.get_entries() if e[0] != keep]
+        total = sum([e[1] for e in entries])
+
+        if nbytes > self.max_bytes:
+            print("warning: file size %d exceeds cache budget %d" % (
+                nbytes, self.max_bytes,
+            ))
+
+        entries.sort(key=lambda e: e[2])
+        for path, size, atime in entries:
+            if total + nbytes <= self.max_bytes:
+                break
+
+            if self.get_refcount(path) > 0:
+                continue
+
+            print("evicting from cache:",path)
+            self._remove_entry(path)
+            total -= size
+
+    def _remove_entry(self, local_fname):
+        """
+        remove the cached file along with its lock and references files;
+        call while holding the cache lock
+        """
+        for fname in [local_fname,
+                      local_fname + LOCK_SUFFIX,
+                      local_fname + REFS_SUFFIX]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def _copy(self, fname, local_fname, st):
+        """
+        copy to a temporary name and rename into place
+        """
+        print("copying to cache: %s -> %s" % (fname,local_fname))
+
+        tmp_fname = '%s.%d%s' % (local_fname, os.getpid(), TMP_SUFFIX)
+        try:
+            shutil.copyfile(fname, tmp_fname)
+            os.utime(tmp_fname, (time.time(), st.st_mtime))
+            os.rename(tmp_fname, local_fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+
+    def _touch(self, local_fname, st):
+        """
+        update the access time, keeping the source mtime
+        """
+        os.utime(local_fname, (time.time(), st.st_mtime))
+
+    def _read_refs(self, local_fname):
+        """
+        read the references, dropping those from dead processes
+        """
+        fname = local_fname + REFS_SUFFIX
+        try:
+            with open(fname) as fobj:
+                refs = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return []
+
+        return [r for r in refs if _is_alive(r)]
+
+    def _write_refs(self, local_fname, refs):
+        """
+        write the references, or remove the file if there are none
+        """
+        fname = local_fname + REFS_SUFFIX
+        if len(refs) == 0:
+            if os.path.exists(fname):
+                os.remove(fname)
+            return
+
+        tmp_fname = '%s.%d%s' % (fname, os.getpid(), TMP_SUFFIX)
+        with open(tmp_fname,'w') as fobj:
+            json.dump(refs, fobj)
+        os.rename(tmp_fname, fname)
+
+    def _lock(self):
+        """
+        lock for the references and eviction
+        """
+        return _FileLock(os.path.join(self.dir, LOCK_NAME))
+
+    def _file_lock(self, local_fname):
+        """
+        lock for copying a single file
+        """
+        return _FileLock(local_fname + LOCK_SUFFIX)
+
+def _get_ref(holder):
+    return '%s:%d' % (socket.gethostname(), holder)
+
+def _is_alive(ref):
+    """
+    check if the holder process is alive.  Holders on other hosts are
+    assumed to be alive
+    """
+    host, pid = ref.rsplit(':',1)
+    if host != socket.gethostname():
+        return True
+
+    try:
+        os.kill(int(pid), 0)
+    except OSError as err:
+        # EPERM means it exists but is owned by someone else
+        return err.errno == errno.EPERM
+
+    return True
+
+
+class _FileLock(object):
+    """
+    exclusive lock on a file, for use in a with statement
+    """
+    def __init__(self, fname):
+        self.fname=fname
+
+    def __enter__(self):
+        while True:
+            self.fobj=open(self.fname, 'a')
+            fcntl.flock(self.fobj, fcntl.LOCK_EX)
+
+            # the lock file may have been removed with an evicted file
+            # while we waited, in which case the lock is on a file others
+            # no longer see
+            try:
+                same = (
+                    os.fstat(self.fobj.fileno()).st_ino
+                    == os.stat(self.fname).st_ino
+                )
+            except OSError:
+                same = False
+
+            if same:
+                return self
+
+            fcntl.flock(self.fobj, fcntl.LOCK_UN)
+            self.fobj.close()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        fcntl.flock(self.fobj, fcntl.LOCK_UN)
+        self.fobj.close()
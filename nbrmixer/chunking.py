@@ -0,0 +1,211 @@
+"""
+split the indices for a run into chunks with balanced cost
+
+The cost of each index is estimated from the size of the output file,
+the number of rows in its header, or the run time recorded in the log.
+For a run with no outputs yet, the size and rows can come from the number
+of objects in the input MEDS files.
+The indices are then packed into chunks with the longest processing time
+rule: the most expensive remaining index goes to the chunk with the least
+total cost so far.
+"""
+from __future__ import print_function
+try:
+    xrange
+except:
+    xrange=range
+
+import os
+import re
+import heapq
+
+from . import files
+
+COST_TYPES=['size','nrows','runtime']
+
+# elapsed time printed by /usr/bin/time, e.g. 1:02:03elapsed or 2:03.45elapsed
+_elapsed_regex = re.compile(
+    r'(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)elapsed'
+)
+
+def get_costs(run, njobs, cost_type, status=None, meds_files=None):
+    """
+    estimate the cost of processing each index
+
+    Indices with no estimate, for example because the output does not
+    exist yet, get the median of the known costs, or 1 if none are known.
+    If the MEDS files are sent, the size and nrows costs for those indices
+    come from the number of objects in the MEDS file instead
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    njobs: int
+        Number of output indices
+    cost_type: string
+        'size' for the output file size, 'nrows' for the number of rows
+        in the output file header, 'runtime' for the run time in the log
+    status: RunStatus, optional
+        Table of existing products, used to get the sizes without a
+        stat for each file
+    meds_files: list, optional
+        The input MEDS file for each index
+
+    returns
+    -------
+    costs: array
+        The cost for each index
+    """
+    import numpy
+
+    if cost_type not in COST_TYPES:
+        raise ValueError("bad cost type '%s', should be one "
+                         "of %s" % (cost_type, COST_TYPES))
+
+    costs = numpy.zeros(njobs) + numpy.nan
+    for index in xrange(njobs):
+        if cost_type == 'size':
+            cost = _get_size(files.get_output_file(run, index), status)
+        elif cost_type == 'nrows':
+            cost = _get_nrows(files.get_output_file(run, index), status)
+        else:
+            cost = _get_runtime(files.get_log_file(run, index))
+
+        if cost is not None:
+            costs[index] = cost
+
+    w,=numpy.where(numpy.isfinite(costs) & (costs > 0))
+    print("cost estimates from %s for %d/%d" % (cost_type, w.size, njobs))
+
+    if meds_files is not None and cost_type in ['size','nrows']:
+        _fill_meds_costs(costs, meds_files, cost_type)
+        w,=numpy.where(numpy.isfinite(costs) & (costs > 0))
+
+    if w.size > 0:
+        default = numpy.median(costs[w])
+    else:
+        default = 1.0
+
+    bad = ~(numpy.isfinite(costs) & (costs > 0))
+    costs[bad] = default
+    return costs
+
+def balanced_chunks(costs, nchunks):
+    """
+    pack the indices into chunks with the longest processing time rule
+
+    parameters
+    ----------
+    costs: array
+        The cost for each index
+    nchunks: int
+        Number of chunks
+
+    returns
+    -------
+    chunks: list
+        List of sorted index lists, ordered by the first index.  Empty
+        chunks are not returned
+    """
+    import numpy
+
+    costs = numpy.array(costs, ndmin=1, dtype='f8')
+    nchunks = max(1, min(nchunks, costs.size))
+
+    # heap of (total cost, chunk number)
+    heap = [(0.0, i) for i in xrange(nchunks)]
+    chunks = [[] for i in xrange(nchunks)]
+
+    # stable sort so equal costs keep index order
+    order = numpy.argsort(-costs, kind='mergesort')
+    for index in order:
+        total, ichunk = heapq.heappop(heap)
+        chunks[ichunk].append(int(index))
+        heapq.heappush(heap, (total + costs[index], ichunk))
+
+    chunks = [sorted(c) for c in chunks if len(c) > 0]
+    chunks.sort(key=lambda c: c[0])
+    return chunks
+
+def _fill_meds_costs(costs, meds_files, cost_type):
+    """
+    fill in the costs for indices with no output from the number of
+    objects in the MEDS file
+
+    The output has a row per object, so nrows is used directly.  Sizes
+    are scaled by the median bytes per object of the indices with
+    outputs; with none, the number of objects is used, which gives the
+    same relative costs
+    """
+    import numpy
+    from . import splits
+
+    known = numpy.isfinite(costs) & (costs > 0)
+    if known.all():
+        return
+
+    if cost_type == 'nrows':
+        indices, = numpy.where(~known)
+    else:
+        indices = xrange(costs.size)
+
+    nobj = numpy.zeros(costs.size) + numpy.nan
+    for index in indices:
+        n = splits.get_nfof(meds_files[index])
+        if n is not None:
+            nobj[index] = n
+
+    scale = 1.0
+    if cost_type == 'size':
+        w, = numpy.where(known & numpy.isfinite(nobj) & (nobj > 0))
+        if w.size > 0:
+            scale = numpy.median(costs[w]/nobj[w])
+
+    fill = ~known & numpy.isfinite(nobj)
+    costs[fill] = scale*nobj[fill]
+
+    print("cost estimates from MEDS objects for %d" % fill.sum())
+
+def _get_size(fname, status):
+    if status is not None:
+        return status.get_size(fname)
+
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return None
+
+def _get_nrows(fname, status):
+    import fitsio
+
+    if status is not None and not status.exists(fname):
+        return None
+
+    try:
+        with fitsio.FITS(fname) as fits:
+            return fits[1].get_nrows()
+    except (IOError, OSError):
+        return None
+
+def _get_runtime(fname):
+    """
+    get the elapsed time in seconds printed by /usr/bin/time in the
+    log, or None if not found
+    """
+    try:
+        with open(fname) as fobj:
+            text = fobj.read()
+    except (IOError, OSError):
+        return None
+
+    matches = _elapsed_regex.findall(text)
+    if len(matches) == 0:
+        return None
+
+    hours, minutes, seconds = matches[-1]
+    runtime = float(seconds) + 60*float(minutes)
+    if hours != '':
+        runtime += 3600*float(hours)
+
+    return runtime
@@ -0,0 +1,743 @@
+"""
+collate the outputs for a run into a single file, joined to the truth
+"""
+from __future__ import print_function
+try:
+    xrange
+except:
+    xrange=range
+
+import os
+import collections
+import hashlib
+import json
+import numpy
+import fitsio
+
+from . import files
+from . import util
+from . import selection
+from . import columnar
+
+# column added to identify the output file for each row
+FILE_ID_DT=[('file_id','i4')]
+
+# rows of the collated file for each file_id
+INDEX_DT=[('file_id','i4'),('row_start','i8'),('nrows','i8')]
+
+class Collator(object):
+    """
+    collate the output files for a run
+
+    A manifest is kept next to the collated file, recording the size,
+    mtime and content hash of each output file and the rows it occupies.
+    When the collated file is redone only new or changed output files are
+    processed.  New files are appended and changed files are rewritten in
+    place; the file is only repacked when files were removed or changed
+    size.
+
+    The dtype of the collated rows is fixed once per run, from the
+    existing collated file or the first output file, and the rows for
+    each file are assembled in a single array of that dtype.
+
+    The table is sized up front from the NAXIS2 header entries of the
+    output files, and each file is written at its row offset, rather
+    than growing the table with each file.
+
+    An index giving the rows for each file_id is written next to the
+    collated file, so the rows for one index can be read by range; see
+    get_row_range
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    match: bool, optional
+        If True match to the truth catalog, otherwise use the already
+        matched catalog
+    one_to_one: bool, optional
+        If True, use one-to-one matching to truth
+    nproc: int, optional
+        Number of processes used to read and join the files.  The results
+        are always written by this process, in order of index
+    maxpending: int, optional
+        Maximum number of processed files waiting to be written when
+        nproc > 1.  Default 2*nproc
+    clobber: bool, optional
+        If True, ignore any existing manifest and redo all files
+    columns: list or string, optional
+        Patterns for the columns to keep from the output files, e.g.
+        'mcal_g*'.  Default is to take them from the collate_columns
+        entry in the run config, and if that is not present to keep all
+        columns
+    columnar: bool, optional
+        If True, also write a copy of the collated file with one .npy
+        file per column; see the columnar module
+    """
+    def __init__(self, run,
+                 match=False,
+                 one_to_one=False,
+                 nproc=1,
+                 maxpending=None,
+                 clobber=False,
+                 columns=None,
+                 columnar=False):
+        import nbrsim
+
+        self.run=run
+        self.match=match
+        self.one_to_one=one_to_one
+        self.nproc=nproc
+        self.clobber=clobber
+        self.columnar=columnar
+
+        if maxpending is None:
+            maxpending=2*nproc
+        self.maxpending=maxpending
+
+        self.conf = files.read_config(run)
+
+        if columns is None:
+            columns = self.conf.get('collate_columns',None)
+        self.columns = selection.parse_list(columns)
+
+        nbrsim_conf = nbrsim.files.read_config(self.conf['nbrsim_run'])
+        self.njobs=nbrsim_conf['output']['nfiles']
+
+        self.collated_file = files.get_collated_file(run)
+        self.manifest_file = files.get_collated_manifest_file(run)
+        self.index_file = files.get_collated_index_file(run)
+        self.dtype = None
+
+    def go(self):
+        """
+        read, join and write the new or changed files
+        """
+
+        collated_dir = files.get_collated_dir(self.run)
+        if not os.path.exists(collated_dir):
+            os.makedirs(collated_dir)
+
+        print("will write to:",self.collated_file)
+
+        manifest = self._read_manifest()
+        status = self._get_status(manifest)
+
+        print("unchanged: %d new: %d changed: %d removed: %d" % (
+            len(status['unchanged']),
+            len(status['new']),
+            len(status['changed']),
+            len(status['removed']),
+        ))
+
+        self.dtype = self._get_dtype(
+            sorted(status['changed'] + status['new']),
+            status['repack'],
+        )
+
+        # the manifest and index are invalid until the collated file is
+        # consistent again
+        for fname in [self.manifest_file, self.index_file]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+        if status['repack']:
+            entries = self._repack(manifest, status)
+        else:
+            entries = self._update(manifest, status)
+
+        self._write_manifest(entries)
+        self._write_index(entries)
+
+        print("output is in:",self.collated_file)
+
+        if self.columnar:
+            if columnar.get_store(self.run) is None:
+                columnar.write_columns(self.run)
+            else:
+                print("columns are up to date")
+
+    def _update(self, manifest, status):
+        """
+        rewrite changed files in place and append new ones
+        """
+
+        entries = manifest['entries']
+        failed=[]
+
+        todo = sorted(status['changed'] + status['new'])
+        if len(todo) == 0:
+            return entries
+
+        nrows = manifest['nrows']
+        new = [i for i in todo if i not in status['changed']]
+        nalloc = nrows + sum(self._get_nrows(new).values())
+
+        with fitsio.FITS(self.collated_file,'rw') as fits:
+            hdu=fits[1]
+            if nalloc > nrows:
+                hdu.resize(nalloc)
+
+            for i, data in self._iter_data(todo):
+                key=str(i)
+                if i in status['changed']:
+                    entry = entries[key]
+                    if data is None or data.size != entry['nrows']:
+                        failed.append(i)
+                        continue
+
+                    print("    rewriting rows %d:%d" % (
+                        entry['row_start'], entry['row_start']+data.size,
+                    ))
+                    hdu.write(data, firstrow=entry['row_start'])
+                elif data is not None:
+                    hdu.write(data, firstrow=nrows)
+                    entry = {'row_start':nrows, 'nrows':data.size}
+                    nrows += data.size
+                else:
+                    continue
+
+                entry.update(status['stats'][i])
+                entries[key] = entry
+
+            if hdu.get_nrows() != nrows:
+                # some new files could not be processed
+                hdu.resize(nrows)
+
+        if len(failed) > 0:
+            # these could not be rewritten in place
+            for i in failed:
+                del entries[str(i)]
+
+            manifest = {'entries':entries, 'nrows':nrows}
+            status = {
+                'unchanged': sorted([int(k) for k in entries]),
+                'new':[], 'changed':[], 'removed':failed,
+                'stats':{},
+            }
+            entries = self._repack(manifest, status)
+
+        return entries
+
+    def _repack(self, manifest, status):
+        """
+        write a new collated file, copying unchanged rows from the old
+        file and processing the rest
+        """
+
+        entries = manifest['entries']
+        unchanged = set(status['unchanged'])
+        todo = sorted(status['changed'] + status['new'])
+
+        if len(unchanged) > 0:
+            old_fits = fitsio.FITS(self.collated_file)
+        else:
+            old_fits = None
+
+        tmp_file = self.collated_file + '.tmp'
+
+        # first pass: the rows for each file, from the headers
+        nalloc = sum([entries[str(i)]['nrows'] for i in unchanged])
+        nalloc += sum(self._get_nrows(todo).values())
+
+        dtype = self.dtype
+        if dtype is None and old_fits is not None:
+            dtype = old_fits[1].get_rec_dtype()[0]
+
+        new_entries={}
+        nrows=0
+
+        try:
+            with fitsio.FITS(tmp_file,'rw',clobber=True) as fits:
+                have_table = nalloc > 0 and dtype is not None
+                if have_table:
+                    print("creating table with %d rows" % nalloc)
+                    fits.create_table_hdu(dtype=dtype)
+                    fits[-1].resize(nalloc)
+
+                # second pass: write each file at its offset.  Files that
+                # could not be processed are skipped, and the table is
+                # trimmed at the end
+                for i, data in self._iter_merged(unchanged, todo, entries, old_fits):
+                    if data is None:
+                        continue
+
+                    if have_table:
+                        fits[-1].write(data, firstrow=nrows)
+                    else:
+                        fits.write(data)
+                        have_table = True
+
+                    entry = {'row_start':nrows, 'nrows':data.size}
+                    if i in status['stats']:
+                        entry.update(status['stats'][i])
+                    else:
+                        entry.update(_get_stats_entry(entries[str(i)]))
+
+                    new_entries[str(i)] = entry
+                    nrows += data.size
+
+                if have_table and fits[-1].get_nrows() != nrows:
+                    fits[-1].resize(nrows)
+
+        finally:
+            if old_fits is not None:
+                old_fits.close()
+
+        os.rename(tmp_file, self.collated_file)
+        return new_entries
+
+    def _iter_merged(self, unchanged, todo, entries, old_fits):
+        """
+        yield (index, data) in order of index, reading unchanged
+        rows from the old collated file
+        """
+        processed = self._iter_data(todo)
+        next_processed = next(processed, None)
+
+        for i in sorted(unchanged.union(todo)):
+            if i in unchanged:
+                entry = entries[str(i)]
+                beg = entry['row_start']
+                end = beg + entry['nrows']
+                print("    copying %d rows for %d" % (entry['nrows'], i))
+                yield i, old_fits[1][beg:end]
+            else:
+                yield next_processed
+                next_processed = next(processed, None)
+
+    def _get_status(self, manifest):
+        """
+        compare the output files to the manifest
+        """
+        entries = manifest['entries']
+
+        status = {
+            'unchanged':[],
+            'new':[],
+            'changed':[],
+            'removed':[],
+            'stats':{},
+        }
+
+        for i in xrange(self.njobs):
+            key = str(i)
+            output_file = files.get_output_file(self.run, i)
+
+            if not os.path.exists(output_file):
+                if key in entries:
+                    status['removed'].append(i)
+                continue
+
+            st = os.stat(output_file)
+
+            if key not in entries:
+                status['new'].append(i)
+                status['stats'][i] = _get_file_stats(output_file, st)
+                continue
+
+            entry = entries[key]
+            if st.st_size == entry['size'] and st.st_mtime == entry['mtime']:
+                status['unchanged'].append(i)
+                continue
+
+            # the file was touched, check if the content changed
+            stats = _get_file_stats(output_file, st)
+            if stats['hash'] == entry['hash']:
+                status['unchanged'].append(i)
+                entry.update(stats)
+            else:
+                status['changed'].append(i)
+                status['stats'][i] = stats
+
+        # with no entries, any existing collated file is not described
+        # by the manifest
+        status['repack'] = (
+            len(entries) == 0
+            or len(status['removed']) > 0
+            or not os.path.exists(self.collated_file)
+            or self._have_size_changes(status['changed'], entries)
+        )
+        return status
+
+    def _get_dtype(self, indices, repack):
+        """
+        get the dtype of the collated rows, from the collated file when
+        appending to it, otherwise from the first readable output file
+        """
+        if not repack:
+            with fitsio.FITS(self.collated_file) as fits:
+                return fits[1].get_rec_dtype()[0]
+
+        for i in indices:
+            output_file = files.get_output_file(self.run, i)
+            try:
+                return get_output_dtype(
+                    output_file,
+                    columns=self.columns,
+                    match=self.match,
+                )
+            except IOError:
+                continue
+
+        return None
+
+    def _get_nrows(self, indices):
+        """
+        get the number of rows in each output file from the header,
+        without reading the data.  Unreadable files get zero
+        """
+        nrows={}
+        for i in indices:
+            output_file = files.get_output_file(self.run, i)
+            try:
+                h = fitsio.read_header(output_file, ext=1)
+                nrows[i] = h['NAXIS2']
+            except (IOError, OSError, KeyError):
+                nrows[i] = 0
+
+        return nrows
+
+    def _have_size_changes(self, changed, entries):
+        """
+        check the header of changed files to see if the number of rows
+        changed, in which case they cannot be rewritten in place
+        """
+        for i in changed:
+            output_file = files.get_output_file(self.run, i)
+            try:
+                with fitsio.FITS(output_file) as fits:
+                    nrows = fits[1].get_nrows()
+            except IOError:
+                return True
+
+            if nrows != entries[str(i)]['nrows']:
+                return True
+
+        return False
+
+    def _read_manifest(self):
+        """
+        read the manifest.  An empty manifest is returned if clobber was
+        sent, it is missing, or it was made with different options
+        """
+        manifest = {'entries':{}, 'nrows':0}
+
+        if self.clobber or not os.path.exists(self.manifest_file):
+            return manifest
+
+        if not os.path.exists(self.collated_file):
+            return manifest
+
+        print("reading manifest:",self.manifest_file)
+        with open(self.manifest_file) as fobj:
+            data = json.load(fobj)
+
+        if data['options'] != self._get_options():
+            print("options changed, redoing all files")
+            return manifest
+
+        return data
+
+    def _write_manifest(self, entries):
+        """
+        write the manifest, via a temporary file
+        """
+        nrows = sum([e['nrows'] for e in entries.values()])
+        data = {
+            'options':self._get_options(),
+            'nrows':nrows,
+            'entries':entries,
+        }
+
+        print("writing manifest:",self.manifest_file)
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file,'w') as fobj:
+            json.dump(data, fobj, indent=1, sort_keys=True)
+
+        os.rename(tmp_file, self.manifest_file)
+
+    def _write_index(self, entries):
+        """
+        write the rows for each file_id, sorted by file_id, via a
+        temporary file
+        """
+        index = numpy.zeros(len(entries), dtype=INDEX_DT)
+        for i, key in enumerate(sorted(entries, key=int)):
+            entry = entries[key]
+            index['file_id'][i] = int(key)
+            index['row_start'][i] = entry['row_start']
+            index['nrows'][i] = entry['nrows']
+
+        print("writing index:",self.index_file)
+        tmp_file = self.index_file.replace('.fits','-tmp.fits')
+        fitsio.write(tmp_file, index, extname='index', clobber=True)
+        os.rename(tmp_file, self.index_file)
+
+    def _get_options(self):
+        """
+        options that change the content of the collated file
+        """
+        return {
+            'match':self.match,
+            'one_to_one':self.one_to_one,
+            'columns':self.columns,
+        }
+
+    def _iter_data(self, indices):
+        """
+        yield (index, data) in order of index
+        """
+        if self.nproc > 1:
+            return self._iter_data_pool(indices)
+        else:
+            return self._iter_data_serial(indices)
+
+    def _iter_data_serial(self, indices):
+        for i in indices:
+            yield i, process_file(self._get_job(i))
+
+    def _iter_data_pool(self, indices):
+        """
+        The number of results held in memory is bounded by maxpending;
+        new files are only submitted as results are written
+        """
+        import multiprocessing
+
+        pool = multiprocessing.Pool(processes=self.nproc)
+        try:
+            pending = collections.deque()
+            todo = collections.deque(indices)
+
+            while len(todo) > 0 or len(pending) > 0:
+                while len(todo) > 0 and len(pending) < self.maxpending:
+                    index = todo.popleft()
+                    job = self._get_job(index)
+                    pending.append(
+                        (index, pool.apply_async(process_file, (job,)))
+                    )
+
+                i, res = pending.popleft()
+                yield i, res.get()
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _get_job(self, index):
+        return {
+            'run':self.run,
+            'nbrsim_run':self.conf['nbrsim_run'],
+            'index':index,
+            'njobs':self.njobs,
+            'match':self.match,
+            'one_to_one':self.one_to_one,
+            'columns':self.columns,
+            'dtype':self.dtype,
+        }
+
+def process_file(job):
+    """
+    read an output file, join to truth and add the file index
+
+    The rows are assembled in a single new array with the dtype for the
+    run, with the truth columns and file index filled in place
+
+    parameters
+    ----------
+    job: dict
+        Dict with entries run, nbrsim_run, index, njobs, match,
+        one_to_one, columns and dtype
+
+    returns
+    -------
+    data: array or None
+        None is returned if the file was missing or could not
+        be processed
+    """
+    run=job['run']
+    i=job['index']
+
+    output_file = files.get_output_file(run, i)
+
+    print("%d/%d %s" % (i+1,job['njobs'],output_file))
+
+    if not os.path.exists(output_file):
+        print("missing file:",output_file)
+        return None
+
+    try:
+        odata = read_output(output_file, columns=job['columns'])
+
+        data = numpy.zeros(odata.size, dtype=job['dtype'])
+        _check_columns(odata, data, job['match'])
+
+        if job['match']:
+            # match to truth
+            mdata, nmatch = util.match_truth(
+                odata,
+                job['nbrsim_run'],
+                i,
+                one_to_one=job['one_to_one'],
+                out=data,
+            )
+            if mdata is None:
+                return None
+
+        else:
+            # the truth file was already matched
+            util.add_true_shear(
+                odata,
+                job['nbrsim_run'],
+                i,
+                out=data,
+            )
+
+        data['file_id'] = i
+        return data
+
+    except IOError as err:
+        print("could not read file %s : %s" % (output_file, err))
+    except ValueError as err:
+        print("could process file %s : %s" % (output_file, err))
+
+    return None
+
+def read_index(run):
+    """
+    read the index of the collated file, with the rows for each file_id
+    sorted by file_id, or None if it does not exist
+    """
+    fname = files.get_collated_index_file(run)
+    if not os.path.exists(fname):
+        return None
+
+    return fitsio.read(fname, ext='index')
+
+def get_row_range(run, file_id, index=None):
+    """
+    get the rows of the collated file for the file_id
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    file_id: int
+        The output file index
+    index: array, optional
+        The index from read_index, to avoid reading it again
+
+    returns
+    -------
+    beg, end: int
+        The rows are [beg,end).  None is returned if there is no index
+        or the file_id is not in the collated file
+    """
+    if index is None:
+        index = read_index(run)
+        if index is None:
+            return None
+
+    i = numpy.searchsorted(index['file_id'], file_id)
+    if i >= index.size or index['file_id'][i] != file_id:
+        return None
+
+    beg = int(index['row_start'][i])
+    return beg, beg + int(index['nrows'][i])
+
+def read_output(fname, columns=None):
+    """
+    read an output file, keeping only columns matching the input
+    patterns.  The number column is always read, for the join to truth
+    """
+    with fitsio.FITS(fname) as fits:
+        hdu=fits[1]
+
+        if columns is None:
+            return hdu.read()
+
+        colnames = _get_colnames(hdu, columns)
+        return hdu.read(columns=colnames)
+
+def get_output_dtype(fname, columns=None, match=False):
+    """
+    get the dtype of the collated rows from an output file header: the
+    columns kept from the file, the truth columns and the file index
+    """
+    with fitsio.FITS(fname) as fits:
+        hdu=fits[1]
+
+        if columns is None:
+            colnums = None
+        else:
+            colnames = _get_colnames(hdu, columns)
+            allnames = hdu.get_colnames()
+            colnums = sorted([allnames.index(c) for c in colnames])
+
+        dtype = hdu.get_rec_dtype(colnums=colnums)[0]
+
+    if match:
+        add_dt = util.MATCH_DT
+    else:
+        add_dt = util.TRUE_SHEAR_DT
+
+    return util.add_dtype_fields(dtype, add_dt + FILE_ID_DT)
+
+def _get_colnames(hdu, columns):
+    return selection.match_columns(
+        hdu.get_colnames(),
+        columns,
+        required=['number'],
+    )
+
+def _check_columns(odata, data, match):
+    """
+    check the output file has the columns of the run dtype
+    """
+    if match:
+        add_dt = util.MATCH_DT
+    else:
+        add_dt = util.TRUE_SHEAR_DT
+    added = [d[0] for d in add_dt + FILE_ID_DT]
+
+    expected = set([n for n in data.dtype.names if n not in added])
+    got = set(odata.dtype.names)
+    if got != expected:
+        raise ValueError(
+            "columns differ from the run; missing: %s extra: %s" % (
+                sorted(expected-got), sorted(got-expected),
+            )
+        )
+
+def _get_file_stats(fname, st=None):
+    """
+    get the size, mtime and content hash for the manifest
+    """
+    if st is None:
+        st = os.stat(fname)
+
+    return {
+        'size':st.st_size,
+        'mtime':st.st_mtime,
+        'hash':_get_hash(fname),
+    }
+
+def _get_stats_entry(entry):
+    return dict( (k,entry[k]) for k in ['size','mtime','hash'] )
+
+def _get_hash(fname, blocksize=2**20):
+    """
+    sha1 hash of the file contents
+    """
+    h = hashlib.sha1()
+    with open(fname,'rb') as fobj:
+        while True:
+            buf = fobj.read(blocksize)
+            if not buf:
+                break
+            h.update(buf)
+
+    return h.hexdigest()
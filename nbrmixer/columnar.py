@@ -0,0 +1,204 @@
+"""
+columnar copy of the collated file
+
+Each column is written to its own .npy file, in native byte order, with a
+small json schema listing the columns and the size and mtime of the
+collated file they were made from.  The columns are opened with
+numpy.load(mmap_mode='r'), so repeated passes over a few columns are
+served from the page cache without parsing FITS.
+"""
+from __future__ import print_function
+try:
+    xrange
+except:
+    xrange=range
+
+import os
+import json
+import shutil
+import numpy
+
+from . import files
+
+# default number of rows copied at a time
+DEFAULT_CHUNKSIZE=1000000
+
+def write_columns(run, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    write the columnar copy of the collated file for the run
+
+    The columns are written to a temporary directory which is then
+    renamed into place
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    chunksize: int, optional
+        Number of rows copied at a time
+    """
+    import fitsio
+
+    collated_file = files.get_collated_file(run)
+    dir = files.get_columns_dir(run)
+    tmp_dir = dir + '-tmp'
+
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    print("writing columns to:",dir)
+    st = os.stat(collated_file)
+    try:
+        with fitsio.FITS(collated_file) as fits:
+            hdu = fits[1]
+            nrows = hdu.get_nrows()
+            dtype = hdu.get_rec_dtype()[0]
+
+            outputs = {}
+            schema = []
+            for name in dtype.names:
+                dt = dtype.fields[name][0]
+                base = dt.base.newbyteorder('=')
+                shape = (nrows,) + dt.shape
+
+                fname = os.path.join(tmp_dir, '%s.npy' % name)
+                outputs[name] = numpy.lib.format.open_memmap(
+                    fname,
+                    mode='w+',
+                    dtype=base,
+                    shape=shape,
+                )
+                schema.append({
+                    'name':name,
+                    'dtype':base.str,
+                    'shape':list(dt.shape),
+                })
+
+            for beg in xrange(0, nrows, chunksize):
+                end = min(beg+chunksize, nrows)
+                print("    rows %d:%d" % (beg, end))
+                data = hdu[beg:end]
+                for name in dtype.names:
+                    outputs[name][beg:end] = data[name]
+
+            for name in outputs:
+                outputs[name].flush()
+            del outputs
+
+        _write_schema(
+            os.path.join(tmp_dir, os.path.basename(
+                files.get_columns_schema_file(run))
+            ),
+            {
+                'nrows':nrows,
+                'columns':schema,
+                'source':collated_file,
+                'size':st.st_size,
+                'mtime':st.st_mtime,
+            },
+        )
+
+        if os.path.exists(dir):
+            shutil.rmtree(dir)
+        os.rename(tmp_dir, dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+class ColumnStore(object):
+    """
+    read access to the columnar copy of the collated file
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    """
+    def __init__(self, run):
+        self.run=run
+        self.dir = files.get_columns_dir(run)
+
+        with open(files.get_columns_schema_file(run)) as fobj:
+            self.schema = json.load(fobj)
+
+        self._columns={}
+
+    def is_current(self):
+        """
+        check the columns were made from the current collated file
+        """
+        try:
+            st = os.stat(files.get_collated_file(self.run))
+        except OSError:
+            return False
+
+        return (
+            st.st_size == self.schema['size']
+            and st.st_mtime == self.schema['mtime']
+        )
+
+    def get_colnames(self):
+        return [c['name'] for c in self.schema['columns']]
+
+    def get_nrows(self):
+        return self.schema['nrows']
+
+    def get_column(self, name):
+        """
+        get the memory mapped column
+        """
+        if name not in self._columns:
+            fname = files.get_column_file(self.run, name)
+            self._columns[name] = numpy.load(fname, mmap_mode='r')
+
+        return self._columns[name]
+
+    def read(self, columns=None, beg=0, end=None):
+        """
+        read rows [beg,end) of the columns into a structured array
+
+        parameters
+        ----------
+        columns: list, optional
+            Column names, default all
+        beg: int, optional
+            First row
+        end: int, optional
+            One past the last row, default the number of rows
+        """
+        if columns is None:
+            columns = self.get_colnames()
+        if end is None:
+            end = self.get_nrows()
+
+        byname = dict([(c['name'], c) for c in self.schema['columns']])
+        dtype = []
+        for name in columns:
+            c = byname[name]
+            dtype.append( (name, c['dtype'], tuple(c['shape'])) )
+
+        data = numpy.zeros(max(end-beg,0), dtype=dtype)
+        for name in columns:
+            data[name] = self.get_column(name)[beg:end]
+
+        return data
+
+def get_store(run):
+    """
+    get the ColumnStore for the run, or None if the columns do not
+    exist or are older than the collated file
+    """
+    if not os.path.exists(files.get_columns_schema_file(run)):
+        return None
+
+    store = ColumnStore(run)
+    if not store.is_current():
+        print("columns are out of date with the collated file:",store.dir)
+        return None
+
+    return store
+
+def _write_schema(fname, schema):
+    with open(fname,'w') as fobj:
+        json.dump(schema, fobj, indent=1)
@@ -67,6 +67,21 @@ def get_output_dir(run, index):
     idir = INDEX_FMT % index
     return os.path.join(bdir, run, 'output', idir)
 
+def get_chunk_dir(run):
+    """
+    Directory holding scripts and logs for packed sets of jobs
+    """
+    dir=get_run_dir(run)
+    return os.path.join(dir, 'chunks')
+
+def get_pipeline_dir(run):
+    """
+    Directory holding scripts and logs for the pipeline jobs that
+    combine all indices
+    """
+    dir=get_run_dir(run)
+    return os.path.join(dir, 'pipeline')
+
 def get_collated_dir(run):
     """
     The script directory BASE_DIR/{run}/collated
@@ -106,6 +121,64 @@ def get_log_file(run, index):
 
     return os.path.join(dir, basename)
 
+def get_split_output_file(run, index, split):
+    """
+    output for a range of FoF groups, merged into the output file
+    """
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(
+        run,
+        index=index,
+        type=_get_split_type(split),
+        ext='fits',
+    )
+    return os.path.join(dir, basename)
+
+def get_split_script_file(run, index, split):
+    """
+    script to process a range of FoF groups
+    """
+    dir=get_script_dir(run, index)
+    basename = get_generic_basename(
+        run,
+        index=index,
+        type=_get_split_type(split),
+        ext='sh',
+    )
+    return os.path.join(dir, basename)
+
+def get_split_log_file(run, index, split):
+    """
+    log for processing a range of FoF groups
+    """
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(
+        run,
+        index=index,
+        type=_get_split_type(split),
+        ext='log',
+    )
+    return os.path.join(dir, basename)
+
+def _get_split_type(split):
+    return 'split-%03d' % split
+
+def get_merge_script_file(run, index):
+    """
+    script to merge the outputs for the FoF ranges
+    """
+    dir=get_script_dir(run, index)
+    basename = get_generic_basename(run, index=index, type='merge', ext='sh')
+    return os.path.join(dir, basename)
+
+def get_merge_log_file(run, index):
+    """
+    log for merging the outputs for the FoF ranges
+    """
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(run, index=index, type='merge', ext='log')
+    return os.path.join(dir, basename)
+
 
 def get_collated_file(run):
     """
@@ -116,6 +189,113 @@ def get_collated_file(run):
     basename = get_generic_basename(run, ext='fits')
     return os.path.join(dir, basename)
 
+def get_collated_manifest_file(run):
+    """
+    get the manifest for the collated file, recording the
+    source output files and the rows they occupy
+    """
+
+    dir=get_collated_dir(run)
+    basename = get_generic_basename(run, type='manifest', ext='json')
+    return os.path.join(dir, basename)
+
+def get_collated_index_file(run):
+    """
+    get the index of the collated file, giving the rows for each
+    file_id
+    """
+
+    dir=get_collated_dir(run)
+    basename = get_generic_basename(run, type='index', ext='fits')
+    return os.path.join(dir, basename)
+
+def get_columns_dir(run):
+    """
+    directory holding the columnar copy of the collated file, one
+    .npy file per column
+    """
+    dir=get_collated_dir(run)
+    basename = get_generic_basename(run, type='columns', ext=None)
+    return os.path.join(dir, basename)
+
+def get_column_file(run, name):
+    """
+    .npy file for a column of the collated file
+    """
+    dir=get_columns_dir(run)
+    return os.path.join(dir, '%s.npy' % name)
+
+def get_columns_schema_file(run):
+    """
+    schema for the columnar copy of the collated file
+    """
+    dir=get_columns_dir(run)
+    return os.path.join(dir, 'schema.json')
+
+def get_chunk_script_file(run, chunk, type=None):
+    """
+    script to run a packed set of jobs
+    """
+    dir=get_chunk_dir(run)
+    basename = get_generic_basename(
+        run,
+        type=_get_chunk_type(chunk, type),
+        ext='sh',
+    )
+    return os.path.join(dir, basename)
+
+def get_chunk_log_file(run, chunk, type=None):
+    """
+    log for a packed set of jobs
+    """
+    dir=get_chunk_dir(run)
+    basename = get_generic_basename(
+        run,
+        type=_get_chunk_type(chunk, type),
+        ext='log',
+    )
+    return os.path.join(dir, basename)
+
+def _get_chunk_type(chunk, type):
+    ctype = 'chunk-' + INDEX_FMT % chunk
+    if type is not None:
+        ctype = '%s-%s' % (type, ctype)
+    return ctype
+
+def get_pipeline_script_file(run, type):
+    """
+    script for a pipeline job that combines all indices, e.g. collate
+    """
+    dir=get_pipeline_dir(run)
+    basename = get_generic_basename(run, type=type, ext='sh')
+    return os.path.join(dir, basename)
+
+def get_pipeline_log_file(run, type):
+    """
+    log for a pipeline job that combines all indices
+    """
+    dir=get_pipeline_dir(run)
+    basename = get_generic_basename(run, type=type, ext='log')
+    return os.path.join(dir, basename)
+
+def get_index_sums_script_file(run, select, index):
+    """
+    script to do the sums for a single index in the pipeline
+    """
+    dir=get_script_dir(run, index)
+    type = 'index-sum-%s' % select
+    basename = get_generic_basename(run, index=index, type=type, ext='sh')
+    return os.path.join(dir, basename)
+
+def get_index_sums_log_file(run, select, index):
+    """
+    log for the sums for a single index in the pipeline
+    """
+    dir=get_output_dir(run, index)
+    type = 'index-sum-%s' % select
+    basename = get_generic_basename(run, index=index, type=type, ext='log')
+    return os.path.join(dir, basename)
+
 def get_fof_file(run, index):
     """
     get the fof output file path
@@ -176,6 +356,20 @@ def get_summer_log_file(run, select, index):
     return os.path.join(dir, basename)
 
 
+def get_cache_dir():
+    """
+    directory for the local disk cache, $NBRMIXER_CACHE_DIR if set,
+    otherwise under $TMPDIR or the system temporary directory.  Jobs on
+    the same node share copies if this is set to a shared scratch
+    directory
+    """
+    if 'NBRMIXER_CACHE_DIR' in os.environ:
+        return os.environ['NBRMIXER_CACHE_DIR']
+
+    import tempfile
+    bdir = os.environ.get('TMPDIR', tempfile.gettempdir())
+    return os.path.join(bdir, 'nbrmixer-cache')
+
 #
 # submission scripts
 
@@ -192,6 +386,59 @@ def get_lsf_dir(run):
     """
     return get_wq_dir(run)
 
+def get_wq_file(run, index):
+    """
+    get the yaml file path
+    """
+    dir=get_wq_dir(run)
+    basename = get_generic_basename(run, index=index, ext='yaml')
+    return os.path.join(dir, basename)
+
+def get_chunk_wq_file(run, chunk, type=None):
+    """
+    get the yaml file path for a packed set of jobs
+    """
+    dir=get_wq_dir(run)
+    basename = get_generic_basename(
+        run,
+        type=_get_chunk_type(chunk, type),
+        ext='yaml',
+    )
+    return os.path.join(dir, basename)
+
+def get_chunk_lsf_file(run, chunk, type=None):
+    """
+    get the lsf file path for a packed set of jobs
+    """
+    dir=get_lsf_dir(run)
+    basename = get_generic_basename(
+        run,
+        type=_get_chunk_type(chunk, type),
+        ext='lsf',
+    )
+    return os.path.join(dir, basename)
+
+def get_pipeline_submit_file(run):
+    """
+    script to submit the pipeline lsf jobs in order
+    """
+    dir=get_lsf_dir(run)
+    basename = get_generic_basename(run, type='pipeline-submit', ext='sh')
+    return os.path.join(dir, basename)
+
+def get_local_status_file(run, type=None):
+    """
+    get the path to the file holding the exit status of jobs run
+    locally
+    """
+    dir=get_lsf_dir(run)
+    if type is None:
+        type='local-status'
+    else:
+        type='%s-local-status' % type
+    basename = get_generic_basename(run, type=type, ext='json')
+    return os.path.join(dir, basename)
+
 def get_lsf_file(run, index):
     """
     get the yaml file path
@@ -208,6 +455,40 @@ def get_nbrs_lsf_file(run, index):
     basename = get_generic_basename(run, index=index, type='nbrs', ext='lsf')
     return os.path.join(dir, basename)
 
+def get_lsf_array_file(run, type=None):
+    """
+    get the lsf job array file path
+    """
+    dir=get_lsf_dir(run)
+    if type is None:
+        type='array'
+    else:
+        type='%s-array' % type
+    basename = get_generic_basename(run, type=type, ext='lsf')
+    return os.path.join(dir, basename)
+
+def get_lsf_index_map_file(run, type=None):
+    """
+    get the path to the file mapping lsf job array elements to
+    scripts and logs
+    """
+    dir=get_lsf_dir(run)
+    if type is None:
+        type='array-map'
+    else:
+        type='%s-array-map' % type
+    basename = get_generic_basename(run, type=type, ext='txt')
+    return os.path.join(dir, basename)
+
+def get_summer_wq_file(run, select, index):
+    """
+    get the yaml file path
+    """
+    dir=get_wq_dir(run)
+    type = 'sum-%s' % select
+    basename = get_generic_basename(run, index=index, type=type, ext='yaml')
+    return os.path.join(dir, basename)
+
 def get_summer_lsf_file(run, select, index):
     """
     get the yaml file path
@@ -238,15 +519,30 @@ def get_config_file(identifier):
     name='%s.yaml' % identifier
     return os.path.join(d, name)
 
+# configs already read in this process, keyed by path, holding
+# (mtime, size, config)
+_config_cache={}
+
+CONFIG_CACHE_DIR_KEY='NBRMIXER_CONFIG_CACHE_DIR'
+
 def read_config(identifier):
     """
     read an installed config file
+
+    The parsed config is kept in memory, and reused while the file mtime
+    and size are unchanged.  A copy is returned, so callers can modify it
     """
-    import yaml
+    import copy
+
     f=get_config_file(identifier)
 
-    with open(f) as fobj:
-        c=yaml.load(fobj)
+    st=os.stat(f)
+    entry=_config_cache.get(f)
+    if entry is None or entry[0] != st.st_mtime or entry[1] != st.st_size:
+        entry = (st.st_mtime, st.st_size, read_yaml(f))
+        _config_cache[f] = entry
+
+    c=copy.deepcopy(entry[2])
 
     if 'sim' in c:
         # this is a run configuration
@@ -254,6 +550,71 @@ def read_config(identifier):
 
     return c
 
+def read_yaml(fname):
+    """
+    parse the yaml file, with the C loader when available
+
+    If $NBRMIXER_CONFIG_CACHE_DIR is set, the parsed result is also kept
+    there as a pickle named for the hash of the file contents, so jobs
+    reading the same config do not parse it again
+    """
+    import yaml
+    import hashlib
+
+    with open(fname,'rb') as fobj:
+        text=fobj.read()
+
+    cache_dir=os.environ.get(CONFIG_CACHE_DIR_KEY,None)
+    if cache_dir is not None:
+        cache_file=os.path.join(
+            cache_dir,
+            '%s-py%d.pkl' % (hashlib.sha1(text).hexdigest(), sys.version_info[0]),
+        )
+        data=_read_pickle(cache_file)
+        if data is not None:
+            return data
+
+    loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    data=yaml.load(text, Loader=loader)
+
+    if cache_dir is not None:
+        _write_pickle(cache_file, data)
+
+    return data
+
+def _read_pickle(fname):
+    """
+    read the pickle, or None if it is missing or unreadable
+    """
+    import pickle
+
+    try:
+        with open(fname,'rb') as fobj:
+            return pickle.load(fobj)
+    except Exception:
+        return None
+
+def _write_pickle(fname, data):
+    """
+    write the pickle to a temporary name and rename it into place, so
+    readers never see a partial file
+    """
+    import pickle
+
+    dir=os.path.dirname(fname)
+    tmp_fname='%s.%d.tmp' % (fname, os.getpid())
+    try:
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+
+        with open(tmp_fname,'wb') as fobj:
+            pickle.dump(data, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, fname)
+    except (IOError, OSError) as err:
+        print("could not write config cache %s: %s" % (fname, err))
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
 
 #
 # sums and fitting
@@ -293,6 +654,38 @@ def get_sums_file(run, index=None, extra=None):
     basename = get_generic_basename(run, type=type, ext='fits')
     return os.path.join(dir, basename)
 
+def get_partial_sums_file(run, block, extra=None):
+    """
+    partial reduction of the sums for a block of indices
+    """
+    dir=get_means_dir(run)
+
+    type = ['sums']
+    if extra is not None:
+        type += [extra]
+
+    type += ['partial', '%06d' % block]
+
+    type='-'.join(type)
+    basename = get_generic_basename(run, type=type, ext='fits')
+    return os.path.join(dir, basename)
+
+def get_sums_missing_file(run, extra=None):
+    """
+    list of indices for which the sums file was missing
+    """
+    dir=get_means_dir(run)
+
+    type = ['sums']
+    if extra is not None:
+        type += [extra]
+
+    type += ['missing']
+
+    type='-'.join(type)
+    basename = get_generic_basename(run, type=type, ext='json')
+    return os.path.join(dir, basename)
+
 def get_plot_file(run, extra=None):
     dir=get_means_dir(run)
 
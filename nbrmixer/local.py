@@ -0,0 +1,271 @@
+"""
+run the job scripts on the local machine with a pool of processes
+
+Each job is run in its own temporary directory, which is set as TMPDIR
+for the script so the MEDS stage in goes to local disk.  The log is
+written in the temporary directory and moved into place at the end, as
+for the batch systems.  The MEDS cache is shared by all the jobs, so it
+stays at $NBRMIXER_CACHE_DIR or under the original $TMPDIR.
+"""
+from __future__ import print_function
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+from collections import defaultdict
+
+from . import files
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class LocalRunner(object):
+    """
+    run bash scripts with a pool of workers
+
+    parameters
+    ----------
+    nproc: int, optional
+        Number of jobs to run at once, default the number of cpus
+    retries: int, optional
+        Number of times to retry a failed job, default 0
+    tmpdir: string, optional
+        Directory under which the job temporary directories are made,
+        default $TMPDIR
+    extra_commands: string, optional
+        Extra shell commands to run before each script, e.g. to set
+        up the environment
+    """
+    def __init__(self, nproc=None, retries=0, tmpdir=None, extra_commands=''):
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+
+        self.nproc=nproc
+        self.retries=retries
+        self.tmpdir=tmpdir
+        self.extra_commands=extra_commands
+
+    def run(self, jobs):
+        """
+        run jobs that have no dependencies; see run_dag
+
+        parameters
+        ----------
+        jobs: list
+            List of dicts with entries script and logfile
+
+        returns
+        -------
+        results: list
+            A copy of each job dict with entries name, the position in
+            the list, exit_status, attempts and time added, in the order
+            of the input list
+        """
+        jobs = [dict(job, name=i) for i, job in enumerate(jobs)]
+        return self.run_dag(jobs)
+
+    def run_dag(self, jobs):
+        """
+        run jobs with dependencies, starting each as soon as the jobs
+        it depends on have finished
+
+        A job is skipped if any job it depends on failed or was
+        skipped, unless it has after_any set, in which case it runs
+        once they have all ended.  Dependencies on names not in the
+        list are taken as already done.  Ready jobs are started in
+        order of decreasing cost
+
+        parameters
+        ----------
+        jobs: list
+            List of dicts with entries name, script, logfile, and
+            optionally deps, a list of names, after_any and cost
+
+        returns
+        -------
+        results: list
+            A copy of each job dict with entries exit_status, attempts
+            and time added, in the order of the input list.  The
+            exit_status is None for skipped jobs
+        """
+
+        jobs = [self._prepare(job) for job in jobs]
+        byname = dict([(job['name'], job) for job in jobs])
+        if len(byname) != len(jobs):
+            raise ValueError("job names must be unique")
+
+        waiting={}
+        blocked={}
+        dependents=defaultdict(list)
+        for job in jobs:
+            deps = set([d for d in job.get('deps',[]) if d in byname])
+            waiting[job['name']] = deps
+            blocked[job['name']] = False
+            for d in deps:
+                dependents[d].append(job['name'])
+
+        results={}
+        ready = [job['name'] for job in jobs if len(waiting[job['name']]) == 0]
+
+        def finish(res):
+            """
+            record the result and update the dependents, returning
+            those that are now ready
+            """
+            name=res['name']
+            results[name]=res
+            ok = res['exit_status'] == 0
+
+            newly_ready=[]
+            stack=[(name, ok)]
+            while len(stack) > 0:
+                name, ok = stack.pop()
+                for dname in dependents[name]:
+                    if not ok:
+                        blocked[dname]=True
+                    waiting[dname].discard(name)
+                    if len(waiting[dname]) > 0:
+                        continue
+
+                    djob = byname[dname]
+                    if blocked[dname] and not djob.get('after_any',False):
+                        print("skipping:",djob['script'])
+                        skipped = dict(djob)
+                        skipped['exit_status'] = None
+                        skipped['attempts'] = 0
+                        skipped['time'] = None
+                        results[dname] = skipped
+                        stack.append( (dname, False) )
+                    else:
+                        newly_ready.append(dname)
+
+            return newly_ready
+
+        from multiprocessing.pool import ThreadPool
+
+        done_queue = queue.Queue()
+        pool = ThreadPool(processes=max(1,self.nproc))
+        try:
+            nrunning=0
+            while len(ready) > 0 or nrunning > 0:
+                ready.sort(key=lambda name: -byname[name].get('cost',1.0))
+                while len(ready) > 0 and nrunning < self.nproc:
+                    job = byname[ready.pop(0)]
+                    pool.apply_async(
+                        _run_job_safe,
+                        (job,),
+                        callback=done_queue.put,
+                    )
+                    nrunning += 1
+
+                res = done_queue.get()
+                nrunning -= 1
+                ready += finish(res)
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return [results[job['name']] for job in jobs if job['name'] in results]
+
+    def _prepare(self, job):
+        job = dict(job)
+        job['retries'] = self.retries
+        job['tmpdir'] = self.tmpdir
+        job['extra_commands'] = self.extra_commands
+        return job
+
+def _run_job_safe(job):
+    """
+    run the job, recording an error as a failure so the scheduler
+    is always told the job finished
+    """
+    try:
+        return run_job(job)
+    except Exception as err:
+        print("error running %s: %s" % (job['script'], err))
+        result = dict(job)
+        result['exit_status'] = -1
+        result['attempts'] = 1
+        result['time'] = None
+        return result
+
+def run_job(job):
+    """
+    run a script, retrying on failure
+
+    parameters
+    ----------
+    job: dict
+        Dict with entries script, logfile, and optionally retries,
+        tmpdir and extra_commands
+
+    returns
+    -------
+    result: dict
+        The job with entries exit_status, attempts and time added
+    """
+
+    retries = job.get('retries',0)
+
+    tm0=time.time()
+    for attempt in range(retries+1):
+        exit_status = _run_script(job)
+
+        if exit_status == 0:
+            break
+
+        print("%s failed with exit status %d (attempt %d of %d)" % (
+            job['script'], exit_status, attempt+1, retries+1,
+        ))
+
+    result = dict(job)
+    result['exit_status'] = exit_status
+    result['attempts'] = attempt+1
+    result['time'] = time.time()-tm0
+    return result
+
+def _run_script(job):
+    """
+    run the script once in a new temporary directory
+    """
+    script=job['script']
+    logfile=job['logfile']
+
+    tmpdir = tempfile.mkdtemp(prefix='nbrmixer-', dir=job.get('tmpdir',None))
+
+    try:
+        tmp_logfile = os.path.join(tmpdir, os.path.basename(logfile))
+
+        command = 'bash "%s"' % script
+        extra_commands = job.get('extra_commands','')
+        if extra_commands != '':
+            command = '%s\n%s' % (extra_commands, command)
+
+        env = dict(os.environ)
+        env['NBRMIXER_CACHE_DIR'] = files.get_cache_dir()
+        env['TMPDIR'] = tmpdir
+
+        print("running:",script)
+        with open(tmp_logfile,'w') as fobj:
+            exit_status = subprocess.call(
+                ['bash','-c',command],
+                cwd=tmpdir,
+                env=env,
+                stdout=fobj,
+                stderr=subprocess.STDOUT,
+            )
+
+        shutil.move(tmp_logfile, logfile)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return exit_status
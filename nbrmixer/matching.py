@@ -0,0 +1,408 @@
+"""
+array based matching of x/y positions
+
+The points of the second set are hashed onto a grid with cells of size
+equal to the match radius, and the cell keys are sorted.  Each point of
+the first set then only needs to look in three contiguous windows of
+that sorted key array, one per neighboring column of cells, which are
+found for all points at once with searchsorted.  Candidate pairs are
+evaluated in batches.
+"""
+from __future__ import print_function
+import numpy
+
+# bits for the ambiguity flags from match_with_info
+
+# more than one candidate in the second set
+AMBIG_MULTI = 2**0
+# the matched element of the second set was a candidate for more than one
+# element of the first set
+AMBIG_SHARED = 2**1
+# there were candidates, but all were claimed by closer pairs in one-to-one
+# mode
+AMBIG_LOST = 2**2
+
+
+def close_match(x1, y1, x2, y2, radius, allow, batchsize=1000000, verbose=False):
+    """
+    Find the nearest neighbors between two arrays of x/y
+
+    Same semantics as the original close_match: a pair is a candidate when
+    both |dx| < radius and |dy| < radius, and up to allow candidates are
+    kept for each element of the first set, nearest first when more than
+    allow are found.
+
+    The one difference is that the original code never matched the
+    element of the second set with the smallest x, due to an off-by-one
+    in its window search.
+
+    parameters
+    ----------
+    x1,y1: scalar or array
+         coordinates of a set of points.  Must be same length.
+    x2,y2: scalar or array
+         coordinates of a second set of points.  Must be same length.
+    radius: scalar
+         maximum match distance between pairs (pixels)
+    allow: scalar
+         maximum number of matches in second array to each element in first array.
+    batchsize: int, optional
+        Approximate maximum number of candidate pairs to evaluate at once.
+    verbose: boolean
+         make loud
+
+    returns
+    -------
+    m1,m2: arrays
+        indices into the first and second sets.  m1 is sorted.
+    """
+
+    m1, m2, dist, ncand = _get_pairs(
+        x1, y1, x2, y2, radius,
+        batchsize=batchsize,
+    )
+
+    if m1.size == 0:
+        if verbose:
+            print("no matches found")
+        return numpy.array([]), numpy.array([])
+
+    m1, m2, dist = _keep_nearest(m1, m2, dist, ncand, allow)
+
+    if verbose:
+        print(m1.size,' matches')
+
+    return m1, m2
+
+def match_with_info(x1, y1, x2, y2, radius, one_to_one=False, batchsize=1000000):
+    """
+    match each element of the first set to at most one element of
+    the second set, with diagnostics
+
+    By default the nearest candidate is taken, as in close_match with
+    allow=1, so two elements of the first set can claim the same element
+    of the second set.  With one_to_one=True the conflicts are resolved
+    globally by distance: the closest pair is always kept, and both of
+    its members are removed from consideration for other pairs.
+
+    parameters
+    ----------
+    x1,y1: scalar or array
+         coordinates of a set of points.  Must be same length.
+    x2,y2: scalar or array
+         coordinates of a second set of points.  Must be same length.
+    radius: scalar
+         maximum match distance between pairs (pixels)
+    one_to_one: bool, optional
+        If True, do a one-to-one assignment
+    batchsize: int, optional
+        Approximate maximum number of candidate pairs to evaluate at once.
+
+    returns
+    -------
+    info: array
+        Array with an entry for each element of the first set, with
+        fields
+
+            match_index: index into the second set, -1 for no match
+            match_dist: distance to the match, -9999 for no match
+            match_ncand: number of candidates within the radius
+            match_ambig: ambiguity flags, see AMBIG_MULTI etc.
+    """
+
+    m1, m2, dist, ncand = _get_pairs(
+        x1, y1, x2, y2, radius,
+        batchsize=batchsize,
+    )
+
+    n1=ncand.size
+    n2=numpy.atleast_1d(x2).size
+
+    info = get_info_struct(n1)
+    info['match_ncand'] = ncand
+
+    if m1.size == 0:
+        return info
+
+    # number of first set elements for which each of the second set is a
+    # candidate
+    ncand2 = numpy.bincount(m2, minlength=n2)
+
+    if one_to_one:
+        m1, m2, dist = _assign_one_to_one(m1, m2, dist)
+    else:
+        m1, m2, dist = _keep_nearest(m1, m2, dist, ncand, 1)
+
+    info['match_index'][m1] = m2
+    info['match_dist'][m1] = dist
+
+    ambig = info['match_ambig']
+    ambig[ncand > 1] |= AMBIG_MULTI
+    ambig[m1[ncand2[m2] > 1]] |= AMBIG_SHARED
+
+    w,=numpy.where( (ncand > 0) & (info['match_index'] < 0) )
+    ambig[w] |= AMBIG_LOST
+
+    return info
+
+def get_info_struct(n):
+    """
+    get the array for match_with_info, with the no-match defaults set
+    """
+    dt=[
+        ('match_index','i8'),
+        ('match_dist','f8'),
+        ('match_ncand','i4'),
+        ('match_ambig','i4'),
+    ]
+    info = numpy.zeros(n, dtype=dt)
+    info['match_index'] = -1
+    info['match_dist'] = -9999.0
+    return info
+
+def _assign_one_to_one(m1, m2, dist):
+    """
+    greedy assignment by distance, done in rounds
+
+    In each round the pairs that are the nearest for both of their members
+    are accepted, and all other pairs involving those members are removed.
+    The nearest remaining pair is always accepted, so this gives the same
+    result as accepting pairs one at a time in order of distance.
+    """
+
+    # break ties in distance by the pair id, so the order is total
+    pid = numpy.arange(m1.size)
+
+    keep1=[]
+    keep2=[]
+    keepd=[]
+    while m1.size > 0:
+        best1 = _is_nearest(m1, dist, pid)
+        best2 = _is_nearest(m2, dist, pid)
+
+        w,=numpy.where(best1 & best2)
+        keep1.append(m1[w])
+        keep2.append(m2[w])
+        keepd.append(dist[w])
+
+        used1 = numpy.zeros(m1.max()+1, dtype=bool)
+        used2 = numpy.zeros(m2.max()+1, dtype=bool)
+        used1[m1[w]] = True
+        used2[m2[w]] = True
+
+        w,=numpy.where( ~used1[m1] & ~used2[m2] )
+        m1, m2, dist, pid = m1[w], m2[w], dist[w], pid[w]
+
+    m1 = numpy.concatenate(keep1)
+    m2 = numpy.concatenate(keep2)
+    dist = numpy.concatenate(keepd)
+
+    s=m1.argsort()
+    return m1[s], m2[s], dist[s]
+
+def _is_nearest(ind, dist, pid):
+    """
+    true for the pairs that are the nearest for their index
+    """
+    s=numpy.lexsort( (pid, dist, ind) )
+    rank = _get_rank(ind[s])
+
+    isbest = numpy.zeros(ind.size, dtype=bool)
+    isbest[s[rank == 0]] = True
+    return isbest
+
+def _get_pairs(x1, y1, x2, y2, radius, batchsize=1000000):
+    """
+    get all pairs within the box |dx| < radius, |dy| < radius
+
+    returns
+    -------
+    m1, m2, dist, ncand
+        The pairs are sorted by m1 and, for each m1, in order of increasing
+        x2.  ncand is the number of candidates for each point in the first
+        set.
+    """
+    x1=numpy.atleast_1d(x1).astype('f8', copy=False)
+    y1=numpy.atleast_1d(y1).astype('f8', copy=False)
+    x2=numpy.atleast_1d(x2).astype('f8', copy=False)
+    y2=numpy.atleast_1d(y2).astype('f8', copy=False)
+
+    n1=x1.size
+    ncand=numpy.zeros(n1, dtype='i8')
+
+    if n1 == 0 or x2.size == 0:
+        empty=numpy.zeros(0, dtype='i8')
+        return empty, empty, numpy.zeros(0), ncand
+
+    grid=_Grid(x2, y2, radius)
+    starts, ends = grid.get_windows(x1, y1)
+
+    nwin = (ends-starts).sum(axis=1)
+    cumwin = nwin.cumsum()
+
+    m1list=[]
+    m2list=[]
+    dlist=[]
+
+    beg=0
+    while beg < n1:
+        # choose the batch so the number of pairs is about batchsize
+        if beg == 0:
+            offset=0
+        else:
+            offset=cumwin[beg-1]
+        end = numpy.searchsorted(cumwin, offset+batchsize, side='right')
+        end = max(end, beg+1)
+
+        i1, isort = _expand_windows(
+            starts[beg:end],
+            ends[beg:end],
+        )
+        i1 += beg
+        i2 = grid.ind[isort]
+
+        dx = numpy.abs(x1[i1]-x2[i2])
+        dy = numpy.abs(y1[i1]-y2[i2])
+        w,=numpy.where( (dx < radius) & (dy < radius) )
+
+        if w.size > 0:
+            i1=i1[w]
+            i2=i2[w]
+            dist=numpy.sqrt(dx[w]**2 + dy[w]**2)
+
+            # within a window pairs are in cell order; put them in x order
+            # as the original code did
+            s=numpy.lexsort( (x2[i2], i1) )
+            m1list.append(i1[s])
+            m2list.append(i2[s])
+            dlist.append(dist[s])
+
+        beg=end
+
+    if len(m1list) == 0:
+        empty=numpy.zeros(0, dtype='i8')
+        return empty, empty, numpy.zeros(0), ncand
+
+    m1=numpy.concatenate(m1list)
+    m2=numpy.concatenate(m2list)
+    dist=numpy.concatenate(dlist)
+
+    ncand[:] = numpy.bincount(m1, minlength=n1)
+    return m1, m2, dist, ncand
+
+def _keep_nearest(m1, m2, dist, ncand, allow):
+    """
+    keep up to allow pairs for each m1.  When there are more than allow
+    candidates, the nearest are kept and they are ordered by distance.
+
+    the input must be sorted by m1
+    """
+
+    needsort = ncand[m1] > allow
+    if numpy.any(needsort):
+        # order by distance only where we need to drop candidates
+        pos = numpy.arange(m1.size, dtype='f8')
+        key = numpy.where(needsort, dist, pos)
+        s=numpy.lexsort( (key, m1) )
+        m1=m1[s]
+        m2=m2[s]
+        dist=dist[s]
+
+    rank = _get_rank(m1)
+    w,=numpy.where(rank < allow)
+    return m1[w], m2[w], dist[w]
+
+def _get_rank(m1):
+    """
+    rank within each group of equal values in the sorted array m1
+    """
+    n=m1.size
+    if n == 0:
+        return numpy.zeros(0, dtype='i8')
+
+    isfirst = numpy.ones(n, dtype=bool)
+    isfirst[1:] = m1[1:] != m1[:-1]
+    first = numpy.where(isfirst)[0]
+    group = isfirst.cumsum()-1
+
+    return numpy.arange(n) - first[group]
+
+def _expand_windows(starts, ends):
+    """
+    expand a set of [start,end) windows, several per row, into
+    the row number and position for each element
+    """
+    nper = starts.shape[1]
+    starts=starts.ravel()
+    ends=ends.ravel()
+    nrow_win = starts.size
+
+    counts = ends-starts
+    ntot = counts.sum()
+
+    row = numpy.repeat(numpy.arange(nrow_win, dtype='i8')//nper, counts)
+
+    # position within the concatenated windows, shifted to each window start
+    cstart = numpy.zeros(nrow_win, dtype='i8')
+    cstart[1:] = counts.cumsum()[:-1]
+    pos = numpy.arange(ntot, dtype='i8') - numpy.repeat(cstart-starts, counts)
+
+    return row, pos
+
+class _Grid(object):
+    """
+    hash points onto a grid with cell size equal to the radius, sorted by
+    cell key.  Keys are column-major so the three cells in a column that
+    neighbor a point are contiguous in the sorted keys
+    """
+    def __init__(self, x, y, radius):
+        self.radius=float(radius)
+
+        self.xmin = x.min()
+        self.ymin = y.min()
+
+        cx = self._get_cell(x, self.xmin)
+        cy = self._get_cell(y, self.ymin)
+
+        # room for an empty cell on either side
+        self.ny = cy.max()+3
+
+        keys = self._get_key(cx, cy)
+        self.ind = keys.argsort(kind='stable')
+        self.keys = keys[self.ind]
+
+    def get_windows(self, x, y):
+        """
+        get the [start,end) windows in the sorted points for the
+        three neighboring columns of cells
+
+        returns
+        -------
+        starts, ends: arrays
+            shape (n,3)
+        """
+
+        cx = self._get_cell(x, self.xmin)
+        cy = self._get_cell(y, self.ymin)
+
+        # keep points far off the grid from wrapping into the next column;
+        # any extra candidates are removed by the distance cut
+        cy = cy.clip(-1, self.ny-2)
+
+        starts = numpy.zeros( (x.size,3), dtype='i8')
+        ends = numpy.zeros( (x.size,3), dtype='i8')
+        for i,dcx in enumerate([-1,0,1]):
+            kmin = self._get_key(cx+dcx, cy-1)
+            kmax = self._get_key(cx+dcx, cy+1)
+
+            starts[:,i] = numpy.searchsorted(self.keys, kmin, side='left')
+            ends[:,i] = numpy.searchsorted(self.keys, kmax, side='right')
+
+        return starts, ends
+
+    def _get_cell(self, v, vmin):
+        return numpy.floor( (v-vmin)/self.radius ).astype('i8')
+
+    def _get_key(self, cx, cy):
+        # shift by one so the neighbor cells are never negative
+        return cx*self.ny + (cy+1)
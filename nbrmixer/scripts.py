@@ -4,10 +4,15 @@ try:
 except:
     xrange=range
 import os
+import json
+import glob
 
-import fitsio
-import nbrsim
 from . import files
+from . import selection
+from . import status
+from . import local
+from . import chunking
+from . import splits
 
 class ScriptWriter(dict):
     """
@@ -18,18 +23,73 @@ class ScriptWriter(dict):
     run: string
         run identifier
     system: string
-        Queue system.  Currently supports wq.
+        Queue system.  Currently supports wq, lsf and local.  For local,
+        the scripts are run on this machine with a pool of processes
+    missing: bool, optional
+        Only write submission scripts for jobs with missing outputs
     extra_commands: string
         Extra shell commands to run, e.g. for setting up
         your environment
+    array: bool, optional
+        For lsf, write a single job array submission script and a map
+        from array element to script, rather than a submission script
+        for each index
+    nproc: int, optional
+        For local, the number of jobs to run at once.  Default is
+        the number of cpus
+    retries: int, optional
+        For local, the number of times to retry a failed job
+    nchunks: int, optional
+        If sent, pack the jobs for each stage into this many submissions,
+        with balanced cost
+    cost: string, optional
+        How to estimate the cost of each index, one of
+        nbrmixer.chunking.COST_TYPES.  Default is equal cost.  For local,
+        the most expensive jobs are started first
+    ncores: int, optional
+        For lsf, the number of cores to request for each job.  The jobs
+        packed into a submission are run up to ncores at a time, each
+        in its own scratch directory.  If nchunks is not sent, about
+        ncores jobs are packed into each submission
+    split_size: int, optional
+        If sent, MEDS files with more FoF groups than this are split into
+        ranges processed by separate jobs, with a merge job to make the
+        output file.  The number of groups is from the FoF file when
+        modelling neighbors, so those are only split once the nbrs stage
+        has run, otherwise from the number of objects in the MEDS file.
+        Not supported for correct_meds runs
+    pipeline: bool, optional
+        For lsf, write the jobs for all stages with dependencies, so each
+        job starts when the jobs for the same index in the earlier stages
+        are done, along with a script to submit them in order.  For
+        local, run the stages in the same way.  A collate job is added
+        that runs when all outputs are finished
+    select: string, optional
+        For pipeline, a select config or comma separated list of them.
+        A job to do the sums is added for each index, that runs when its
+        output is done, and a job to add up the sums for each select
     """
 
-    def __init__(self, run, system, missing=False, extra_commands=''):
+    def __init__(self, run, system, missing=False, extra_commands='',
+                 array=False, nproc=None, retries=0, nchunks=None,
+                 cost=None, ncores=1, split_size=None, pipeline=False,
+                 select=None):
         self['run'] = run
         self['extra_commands'] = extra_commands
         self['system'] = system
+        self['nchunks'] = nchunks
+        self['ncores'] = ncores
+        self['split_size'] = split_size
         
         self.missing=missing
+        self.array=array
+        self.nproc=nproc
+        self.retries=retries
+        self.cost=cost
+        self.pipeline=pipeline
+        self.pipeline_select=select
+        self._status=None
+        self._costs=None
 
         self._load_configs()
 
@@ -40,7 +100,47 @@ class ScriptWriter(dict):
     def write_scripts(self):
         """
         write the basic bash scripts and queue submission scripts
+
+        For the local system, the scripts are run rather than
+        submitted, and the number of failed jobs is returned
         """
+        if self['system'] == 'local':
+            return self._run_local(self._write_stage_scripts())
+
+        if self.pipeline:
+            if self['system'] != 'lsf':
+                raise ValueError("pipeline is only supported for "
+                                 "lsf and local systems")
+            if self.array or self['nchunks'] is not None:
+                raise ValueError("pipeline is not supported with arrays "
+                                 "or chunks")
+
+            jobs = self._get_dag_jobs(self._write_stage_scripts())
+            self._write_lsf_pipeline(jobs)
+            return
+
+        if self['nchunks'] is not None or self['ncores'] > 1:
+            for type, jobs in self._pack_stages(self._write_stage_scripts()):
+                if self.array and self['system'] == 'lsf':
+                    if type is None:
+                        atype = 'chunk'
+                    else:
+                        atype = '%s-chunk' % type
+                    self._write_lsf_array(jobs, type=atype)
+                else:
+                    self._write_chunk_submit(jobs, type)
+            return
+
+        if self.array and self['system'] == 'lsf':
+            for type, jobs in self._write_stage_scripts():
+                self._write_lsf_array(jobs, type=type)
+            return
+
+        if self['split_size'] is not None:
+            for type, jobs in self._write_stage_scripts():
+                self._write_job_submits(jobs)
+            return
+
         for i in xrange(self['njobs']):
             if self['system'] == 'wq':
                 self._write_wq(i)
@@ -53,6 +153,713 @@ class ScriptWriter(dict):
 
             self._write_script(i)
 
+    def _write_stage_scripts(self):
+        """
+        write the bash scripts and get the jobs for each stage
+
+        returns
+        -------
+        stages: list
+            List of (type, jobs) in the order they must be run.  Each
+            job is a dict with entries index, script, logfile, done
+            and cost
+        """
+        costs = self._get_costs()
+
+        nbrs_jobs=[]
+        main_jobs=[]
+        merge_jobs=[]
+        for i in xrange(self['njobs']):
+
+            if self.conf['model_nbrs']:
+                self._write_nbrs_script(i)
+                nbrs_jobs.append({
+                    'index':i,
+                    'script':files.get_nbrs_script_file(self['run'], i),
+                    'logfile':files.get_nbrs_log_file(self['run'], i),
+                    'done':self.missing and self._nbrs_done(i),
+                    'cost':costs[i],
+                })
+
+            ranges = self._get_split_ranges(i)
+            if ranges is None:
+                self._write_main_script(i)
+                main_jobs.append({
+                    'index':i,
+                    'script':files.get_script_file(self['run'], i),
+                    'logfile':files.get_log_file(self['run'], i),
+                    'done':self.missing and self._main_done(i),
+                    'cost':costs[i],
+                })
+                continue
+
+            nfof = ranges[-1][1]+1
+            for split, fof_range in enumerate(ranges):
+                self._write_main_script(i, split=split, fof_range=fof_range)
+
+                start,end=fof_range
+                main_jobs.append({
+                    'index':i,
+                    'split':split,
+                    'script':files.get_split_script_file(self['run'], i, split),
+                    'logfile':files.get_split_log_file(self['run'], i, split),
+                    'done':self.missing and self._split_done(i, split),
+                    'cost':costs[i]*(end-start+1)/float(nfof),
+                })
+
+            self._write_merge_script(i, len(ranges))
+            merge_jobs.append({
+                'index':i,
+                'script':files.get_merge_script_file(self['run'], i),
+                'logfile':files.get_merge_log_file(self['run'], i),
+                'done':self.missing and self._main_done(i),
+                'cost':1.0,
+            })
+
+        stages=[]
+        if self.conf['model_nbrs']:
+            stages.append( ('nbrs', nbrs_jobs) )
+
+        stages.append( (None, main_jobs) )
+
+        if len(merge_jobs) > 0:
+            stages.append( ('merge', merge_jobs) )
+
+        return stages
+
+    def _get_split_ranges(self, index):
+        """
+        get the FoF ranges for splitting the index, or None if it
+        is not to be split
+        """
+        import nbrsim
+
+        if self['split_size'] is None or 'correct_meds' in self.conf:
+            return None
+
+        meds_file = nbrsim.files.get_meds_file(
+            self.conf['nbrsim_run'],
+            index,
+        )
+        if self.conf['model_nbrs']:
+            fof_file = files.get_fof_file(self['run'], index)
+            if not self._get_status().exists(fof_file):
+                return None
+        else:
+            fof_file = None
+
+        nfof = splits.get_nfof(meds_file, fof_file=fof_file)
+        if nfof is None or nfof <= self['split_size']:
+            return None
+
+        return splits.get_split_ranges(nfof, self['split_size'])
+
+    def _write_job_submits(self, jobs):
+        """
+        write a submission script for each job that is not done, named
+        for its bash script
+        """
+
+        lsf_dir = files.get_lsf_dir(self['run'])
+        if not os.path.exists(lsf_dir):
+            os.makedirs(lsf_dir)
+
+        if self['system'] == 'lsf':
+            ext = '.lsf'
+            template = _lsf_template
+        elif self['system'] == 'wq':
+            ext = '.yaml'
+            template = _wq_template
+        else:
+            raise RuntimeError("bad system: '%s'" % self['system'])
+
+        for job in jobs:
+            bname = os.path.basename(job['script']).replace('.sh', ext)
+            fname = os.path.join(lsf_dir, bname)
+
+            if self.missing:
+                fname = fname.replace(ext, '-missing'+ext)
+
+                if job['done']:
+                    self._remove(fname)
+                    continue
+
+            self['job_name'] = os.path.basename(fname).replace(ext,'')
+            self['logfile']  = job['logfile']
+            self['script']   = job['script']
+
+            text = template % self
+
+            print("writing:",fname)
+            with open(fname,'w') as fobj:
+                fobj.write(text)
+
+    def _get_costs(self):
+        """
+        get the cost estimate for each index, all equal if no cost
+        type was sent
+        """
+        if self._costs is None:
+            if self.cost is None:
+                self._costs = [1.0]*self['njobs']
+            else:
+                if self.cost in ['size','nrows']:
+                    st = self._get_status()
+                    meds_files = self._get_meds_files()
+                else:
+                    st = None
+                    meds_files = None
+
+                self._costs = chunking.get_costs(
+                    self['run'],
+                    self['njobs'],
+                    self.cost,
+                    status=st,
+                    meds_files=meds_files,
+                )
+
+        return self._costs
+
+    def _get_meds_files(self):
+        """
+        get the input MEDS file for each index, used for the costs
+        when the outputs do not exist yet
+        """
+        import nbrsim
+
+        return [
+            nbrsim.files.get_meds_file(self.conf['nbrsim_run'], i)
+            for i in xrange(self['njobs'])
+        ]
+
+    def _pack_stages(self, stages):
+        """
+        pack the jobs that are not done into chunks with balanced cost,
+        writing a script for each chunk that runs its jobs
+
+        If nchunks was not sent, the number of chunks is chosen to
+        give about ncores jobs in each
+
+        With missing, the chunks are numbered anew, so their scripts get
+        their own names rather than overwriting those of chunks that may
+        still be queued
+
+        returns
+        -------
+        stages: list
+            List of (type, jobs) where each job runs a chunk
+        """
+
+        chunk_dir = files.get_chunk_dir(self['run'])
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+
+        packed_stages=[]
+        for type, jobs in stages:
+            jobs = [job for job in jobs if not job['done']]
+
+            if not self.missing:
+                ctype = type
+            elif type is None:
+                ctype = 'missing'
+            else:
+                ctype = '%s-missing' % type
+
+            nchunks = self['nchunks']
+            if nchunks is None:
+                nchunks = (len(jobs) + self['ncores'] - 1)//self['ncores']
+
+            if len(jobs) > 0:
+                chunks = chunking.balanced_chunks(
+                    [job['cost'] for job in jobs],
+                    nchunks,
+                )
+            else:
+                chunks = []
+
+            packed=[]
+            for ichunk, members in enumerate(chunks):
+                cjobs = [jobs[i] for i in members]
+
+                script_fname = files.get_chunk_script_file(
+                    self['run'], ichunk, type=ctype,
+                )
+                logfile = files.get_chunk_log_file(
+                    self['run'], ichunk, type=ctype,
+                )
+                self._write_chunk_script(script_fname, cjobs)
+
+                packed.append({
+                    'index':ichunk,
+                    'script':script_fname,
+                    'logfile':logfile,
+                    'done':False,
+                    'cost':sum([job['cost'] for job in cjobs]),
+                })
+
+            print("packed %d jobs into %d chunks" % (len(jobs), len(packed)))
+            packed_stages.append( (type, packed) )
+
+        return packed_stages
+
+    def _write_chunk_script(self, script_fname, jobs):
+        """
+        write a script that runs the jobs, up to ncores at a time and
+        most expensive first, with a log for each
+        """
+
+        jobs = sorted(jobs, key=lambda job: -job['cost'])
+
+        commands=[]
+        for job in jobs:
+            name = os.path.basename(job['script']).replace('.sh','')
+            commands.append(_chunk_command_template % {
+                'script':job['script'],
+                'logfile':job['logfile'],
+                'name':name,
+            })
+
+        text = _chunk_script_template % {
+            'ncores':self['ncores'],
+            'commands':'\n'.join(commands),
+        }
+
+        with open(script_fname, 'w') as fobj:
+            fobj.write(text)
+
+    def _write_chunk_submit(self, jobs, type):
+        """
+        write the submission scripts for the chunks, removing any left
+        from an earlier packing of the same kind, all jobs or missing
+        """
+
+        lsf_dir = files.get_lsf_dir(self['run'])
+        if not os.path.exists(lsf_dir):
+            os.makedirs(lsf_dir)
+
+        if self['system'] == 'lsf':
+            get_fname = files.get_chunk_lsf_file
+            ext = '.lsf'
+            template = _lsf_template
+        elif self['system'] == 'wq':
+            get_fname = files.get_chunk_wq_file
+            ext = '.yaml'
+            template = _wq_template
+        else:
+            raise RuntimeError("bad system: '%s'" % self['system'])
+
+        # names are the same apart from the chunk number
+        pattern = get_fname(self['run'], 0, type=type)
+        pattern = pattern.replace(files.INDEX_FMT % 0, '*')
+        if self.missing:
+            pattern = pattern.replace(ext, '-missing'+ext)
+        for fname in glob.glob(pattern):
+            if not self.missing and fname.endswith('-missing'+ext):
+                continue
+            os.remove(fname)
+
+        for job in jobs:
+            fname = get_fname(self['run'], job['index'], type=type)
+            if self.missing:
+                fname = fname.replace(ext, '-missing'+ext)
+
+            job_name = os.path.basename(fname).replace(ext,'')
+
+            self['job_name'] = job_name
+            self['logfile']  = job['logfile']
+            self['script']   = job['script']
+
+            text = template % self
+
+            print("writing:",fname)
+            with open(fname,'w') as fobj:
+                fobj.write(text)
+
+    def _run_local(self, stages):
+        """
+        run the jobs on the local machine
+
+        Each job starts as soon as the jobs for the same index in the
+        earlier stages are done, and is skipped if one of them failed.
+        The results are written to a status file for each stage
+
+        returns
+        -------
+        nfail: int
+            Number of jobs that failed or were skipped
+        """
+
+        runner = local.LocalRunner(
+            nproc=self.nproc,
+            retries=self.retries,
+            extra_commands=self['extra_commands'],
+        )
+
+        jobs = self._get_dag_jobs(stages)
+        print("running %d jobs" % len(jobs))
+        results = runner.run_dag(jobs)
+
+        nfail=0
+        types=[]
+        for job in jobs:
+            if job['type'] not in types:
+                types.append(job['type'])
+
+        for type in types:
+            tresults = [r for r in results if r['type'] == type]
+            self._write_local_status(tresults, type=type)
+            nfail += len([r for r in tresults if r['exit_status'] != 0])
+
+        print("%d jobs failed" % nfail)
+        return nfail
+
+    def _get_dag_jobs(self, stages):
+        """
+        get the jobs that are not done, with names and dependencies
+
+        Each job depends on the jobs for the same index in the previous
+        stage.  For pipeline mode, jobs are added for the per-index sums
+        and for the collation and the final sums over all indices
+
+        returns
+        -------
+        jobs: list
+            Job dicts with entries name, type, deps, and depend_patterns
+            for the jobs that depend on all jobs in some stages
+        """
+
+        dag=[]
+        # names of the latest jobs for each index
+        latest={}
+        for type, jobs in stages:
+            stage_names={}
+            for job in jobs:
+                index=job['index']
+                if job['done']:
+                    stage_names.setdefault(index, [])
+                    continue
+
+                job = dict(job)
+                job['type'] = type
+                job['name'] = self._get_job_name(type, job)
+                job['deps'] = latest.get(index, [])
+                job['depend_patterns'] = None
+
+                dag.append(job)
+                stage_names.setdefault(index, []).append(job['name'])
+
+            latest.update(stage_names)
+
+        if self.pipeline:
+            dag += self._get_pipeline_jobs(dag, latest)
+
+        return dag
+
+    def _get_pipeline_jobs(self, dag, latest):
+        """
+        get the collate job and, if a select was sent, the per-index sums
+        jobs and the jobs to add up the sums
+        """
+
+        run=self['run']
+
+        pipeline_dir = files.get_pipeline_dir(run)
+        if not os.path.exists(pipeline_dir):
+            os.makedirs(pipeline_dir)
+
+        output_types = [None, 'merge']
+        output_names = [j['name'] for j in dag if j['type'] in output_types]
+        output_patterns = []
+        for type in output_types:
+            if any(j['type'] == type for j in dag):
+                output_patterns.append(
+                    self._get_job_name(type, {'index':0}).replace('000000','*')
+                )
+
+        pjobs=[]
+
+        pjobs.append(self._get_final_job(
+            'collate',
+            _collate_script_template % {'run':run},
+            output_names,
+            output_patterns,
+        ))
+
+        if self.pipeline_select is None:
+            return pjobs
+
+        select_list = selection.parse_list(self.pipeline_select)
+        select_set = get_select_set_name(self.pipeline_select)
+        sum_type = 'sum-%s' % select_set
+
+        sum_names=[]
+        for index in xrange(self['njobs']):
+            deps = latest.get(index, [])
+            if self.missing and len(deps) == 0:
+                if self._sums_done(index, select_list):
+                    continue
+
+            script_fname = files.get_index_sums_script_file(
+                run, select_set, index,
+            )
+            text = _summer_script_template % {
+                'run':run,
+                'select_string':'--select="%s"' % self.pipeline_select,
+                'index_option':get_index_option([index]),
+                'force':'--force',
+            }
+            with open(script_fname,'w') as fobj:
+                fobj.write(text)
+
+            job = {
+                'index':index,
+                'type':sum_type,
+                'script':script_fname,
+                'logfile':files.get_index_sums_log_file(
+                    run, select_set, index,
+                ),
+                'deps':deps,
+                'depend_patterns':None,
+                'done':False,
+                'cost':1.0,
+            }
+            job['name'] = self._get_job_name(sum_type, job)
+
+            pjobs.append(job)
+            sum_names.append(job['name'])
+
+        if len(sum_names) > 0:
+            sum_patterns = [
+                self._get_job_name(sum_type, {'index':0}).replace('000000','*')
+            ]
+        else:
+            sum_patterns = []
+
+        for select in select_list:
+            pjobs.append(self._get_final_job(
+                'sum-all-%s' % select,
+                _sum_all_script_template % {'run':run, 'select':select},
+                sum_names,
+                sum_patterns,
+            ))
+
+        return pjobs
+
+    def _get_final_job(self, type, text, deps, depend_patterns):
+        """
+        write the script for a job that combines all indices, and get
+        the job, which runs after all of its dependencies have ended
+        """
+
+        script_fname = files.get_pipeline_script_file(self['run'], type)
+        with open(script_fname,'w') as fobj:
+            fobj.write(text)
+
+        return {
+            'index':0,
+            'type':type,
+            'name':'%s-%s' % (self['run'], type),
+            'script':script_fname,
+            'logfile':files.get_pipeline_log_file(self['run'], type),
+            'deps':deps,
+            'depend_patterns':depend_patterns,
+            'after_any':True,
+            'done':False,
+            'cost':1.0,
+        }
+
+    def _sums_done(self, index, select_list):
+        """
+        check if the sums files for the index exist for each select
+        """
+        st = self._get_status()
+        for select in select_list:
+            fname = files.get_sums_file(self['run'], extra=select, index=index)
+            if not st.exists(fname):
+                return False
+        return True
+
+    def _write_lsf_pipeline(self, jobs):
+        """
+        write an lsf file for each job, with the dependencies as a -w
+        condition, and a script to submit them in order
+        """
+
+        lsf_dir = files.get_lsf_dir(self['run'])
+        if not os.path.exists(lsf_dir):
+            os.makedirs(lsf_dir)
+
+        lsf_fnames=[]
+        for job in jobs:
+            lsf_fname = os.path.join(lsf_dir, '%s.lsf' % job['name'])
+
+            self['job_name'] = job['name']
+            self['logfile']  = job['logfile']
+            self['script']   = job['script']
+
+            text = _lsf_template  % self
+
+            condition = get_lsf_condition(job)
+            if condition is not None:
+                text = text.replace(
+                    '#BSUB -n',
+                    '#BSUB -w "%s"\n#BSUB -n' % condition,
+                    1,
+                )
+
+            with open(lsf_fname,'w') as fobj:
+                fobj.write(text)
+            lsf_fnames.append(lsf_fname)
+
+        print("wrote %d lsf files" % len(lsf_fnames))
+
+        # jobs are in dependency order
+        submit_fname = files.get_pipeline_submit_file(self['run'])
+        commands = ['bsub < "%s"' % f for f in lsf_fnames]
+        text = _lsf_pipeline_submit_template % {
+            'commands':'\n'.join(commands),
+        }
+
+        print("writing:",submit_fname)
+        with open(submit_fname,'w') as fobj:
+            fobj.write(text)
+
+    def _get_job_name(self, type, job):
+        """
+        name of the job, unique within the run
+        """
+        if type is None:
+            type='main'
+
+        name = '%s-%s-%06d' % (self['run'], type, job['index'])
+        if 'split' in job:
+            name = '%s-split-%03d' % (name, job['split'])
+
+        return name
+
+    def _write_local_status(self, results, type=None):
+        """
+        write the exit status of the locally run jobs
+        """
+
+        lsf_dir = files.get_lsf_dir(self['run'])
+        if not os.path.exists(lsf_dir):
+            os.makedirs(lsf_dir)
+
+        fname = files.get_local_status_file(self['run'], type=type)
+        print("writing:",fname)
+
+        output = []
+        for res in sorted(results, key=lambda r: r['index']):
+            output.append({
+                'index':res['index'],
+                'script':res['script'],
+                'logfile':res['logfile'],
+                'exit_status':res['exit_status'],
+                'attempts':res['attempts'],
+                'time':res.get('time',None),
+            })
+
+        with open(fname,'w') as fobj:
+            json.dump(output, fobj, indent=1)
+
+    def _write_lsf_array(self, jobs, type=None):
+        """
+        write the index map and the lsf job array script
+
+        The map has a line for each job, with the script and log file.  The
+        array elements are line numbers in the map; only elements for
+        jobs that are not done are included
+
+        parameters
+        ----------
+        jobs: list
+            List of dicts with entries script, logfile and done
+        type: string, optional
+            Type of job, e.g. nbrs, used in the file names
+        """
+
+        lsf_dir = files.get_lsf_dir(self['run'])
+        if not os.path.exists(lsf_dir):
+            os.makedirs(lsf_dir)
+
+        map_fname = files.get_lsf_index_map_file(self['run'], type=type)
+        lsf_fname = files.get_lsf_array_file(self['run'], type=type)
+        if self.missing:
+            # queued elements of an earlier array read the original map
+            map_fname = map_fname.replace('.txt','-missing.txt')
+            lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
+
+        if os.path.exists(lsf_fname):
+            os.remove(lsf_fname)
+
+        print("writing:",map_fname)
+        with open(map_fname,'w') as fobj:
+            for job in jobs:
+                fobj.write('%s %s\n' % (job['script'], job['logfile']))
+
+        elements = [i+1 for i,job in enumerate(jobs) if not job['done']]
+        if len(elements) == 0:
+            print("no jobs to run for:",lsf_fname)
+            return
+
+        job_name = os.path.basename(lsf_fname)
+        job_name = job_name.replace('.lsf','')
+
+        self['job_name'] = job_name
+        self['array_spec'] = get_array_spec(elements)
+        self['index_map'] = map_fname
+
+        text = _lsf_array_template  % self
+
+        print("writing:",lsf_fname)
+        with open(lsf_fname,'w') as fobj:
+            fobj.write(text)
+
+    def _main_done(self, index):
+        """
+        check if the output file for this index exists
+        """
+        output_file = files.get_output_file(self['run'], index)
+        return self._get_status().exists(output_file)
+
+    def _split_done(self, index, split):
+        """
+        check if the output for the split, or the merged output, exists
+        """
+        split_file = files.get_split_output_file(self['run'], index, split)
+        return self._main_done(index) or self._get_status().exists(split_file)
+
+    def _nbrs_done(self, index):
+        """
+        check if the nbrs and fof files for this index exist
+        """
+        nbrs_file = files.get_nbrs_file(self['run'], index)
+        fof_file = files.get_fof_file(self['run'], index)
+        st = self._get_status()
+        return st.exists(nbrs_file) and st.exists(fof_file)
+
+    def _remove(self, fname):
+        """
+        remove a stale submission script, if it exists
+        """
+        if self._get_status().exists(fname):
+            os.remove(fname)
+
+    def _get_status(self):
+        """
+        get the table of existing products, listing the directories
+        on first use
+        """
+        if self._status is None:
+            print("scanning products for run:",self['run'])
+            self._status = status.RunStatus(
+                self['run'],
+                self['njobs'],
+                means=self.pipeline,
+            )
+        return self._status
+
     def _write_script(self, index):
         if self.conf['model_nbrs']:
             self._write_nbrs_script(index)
@@ -62,6 +869,7 @@ class ScriptWriter(dict):
         """
         write the nbrs bash script
         """
+        import nbrsim
 
         self['meds_file'] = nbrsim.files.get_meds_file(
             self.conf['nbrsim_run'],
@@ -80,20 +888,43 @@ class ScriptWriter(dict):
             fobj.write(text)
 
 
-    def _write_main_script(self, index):
+    def _write_main_script(self, index, split=None, fof_range=None):
         """
         write the basic bash script
+
+        parameters
+        ----------
+        index: int
+            The output index
+        split: int, optional
+            The split number, if processing a range of FoF groups
+        fof_range: tuple, optional
+            The (start,end) inclusive range of FoF groups for the split
         """
+        import nbrsim
 
         self['meds_file'] = nbrsim.files.get_meds_file(
             self.conf['nbrsim_run'],
             index,
         )
-        self['start']=0
-        self['end']=1000000000
 
-        self['output_file'] = files.get_output_file(self['run'], index)
-        
+        if fof_range is None:
+            self['start']=0
+            self['end']=1000000000
+        else:
+            self['start'],self['end']=fof_range
+
+        if split is None:
+            self['output_file'] = files.get_output_file(self['run'], index)
+            script_fname=files.get_script_file(self['run'], index)
+        else:
+            self['output_file'] = files.get_split_output_file(
+                self['run'],
+                index,
+                split,
+            )
+            script_fname=files.get_split_script_file(self['run'], index, split)
+
         if self.conf['model_nbrs']:
             self['fof_file'] = files.get_fof_file(self['run'], index)
             self['nbrs_file'] = files.get_nbrs_file(self['run'], index)
@@ -107,11 +938,25 @@ class ScriptWriter(dict):
         else:
             text=_script_template % self
 
-        script_fname=files.get_script_file(self['run'], index)
         #print("writing:",script_fname)
         with open(script_fname, 'w') as fobj:
             fobj.write(text)
 
+    def _write_merge_script(self, index, nsplit):
+        """
+        write the script to merge the outputs for the splits
+        """
+
+        text=_merge_script_template % {
+            'run':self['run'],
+            'index':index,
+            'nsplit':nsplit,
+        }
+
+        script_fname=files.get_merge_script_file(self['run'], index)
+        with open(script_fname, 'w') as fobj:
+            fobj.write(text)
+
 
     def _write_wq(self, index):
         """
@@ -127,10 +972,8 @@ class ScriptWriter(dict):
         if self.missing:
             wq_fname = wq_fname.replace('.yaml','-missing.yaml')
 
-            output_file = files.get_output_file(self['run'], index)
-            if os.path.exists(output_file):
-                if os.path.exists(wq_fname):
-                    os.remove(wq_fname)
+            if self._main_done(index):
+                self._remove(wq_fname)
                 return
 
         job_name = os.path.basename(wq_fname)
@@ -166,11 +1009,8 @@ class ScriptWriter(dict):
         if self.missing:
             lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
 
-            nbrs_file = files.get_nbrs_file(self['run'], index)
-            fof_file = files.get_fof_file(self['run'], index)
-            if os.path.exists(nbrs_file) and os.path.exists(fof_file):
-                if os.path.exists(lsf_fname):
-                    os.remove(lsf_fname)
+            if self._nbrs_done(index):
+                self._remove(lsf_fname)
                 return
 
         job_name = os.path.basename(lsf_fname)
@@ -200,10 +1040,8 @@ class ScriptWriter(dict):
         if self.missing:
             lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
 
-            output_file = files.get_output_file(self['run'], index)
-            if os.path.exists(output_file):
-                if os.path.exists(lsf_fname):
-                    os.remove(lsf_fname)
+            if self._main_done(index):
+                self._remove(lsf_fname)
                 return
 
         job_name = os.path.basename(lsf_fname)
@@ -236,8 +1074,15 @@ class ScriptWriter(dict):
             if script_dir != output_dir:
                 dirs += [script_dir]
 
+        # one listing of each parent rather than a check for each dir
+        present=set()
+        for parent in set([os.path.dirname(d) for d in dirs]):
+            present.update(
+                [os.path.join(parent,n) for n in status.listdir(parent)]
+            )
+
         for d in dirs:
-            if not os.path.exists(d):
+            if d not in present:
                 try:
                     print("making dir:",d)
                     os.makedirs(d)
@@ -248,6 +1093,8 @@ class ScriptWriter(dict):
         """
         load the galsim config and do some checks
         """
+        import nbrsim
+
         self['config_file']=files.get_config_file(self['run'])
 
         self.conf = files.read_config(self['run'])
@@ -256,18 +1103,54 @@ class ScriptWriter(dict):
         self.nbrsim_conf = nbrsim.files.read_config(self.conf['nbrsim_run'])
 
 class SummerScriptWriter(ScriptWriter):
+    """
+    write scripts to do the sums for chunks of output files
+
+    select_conf can be a comma separated list of select configs, in
+    which case each job does the sums for all of them in a single pass
+    over the data.  The scripts are then named for the set of selections
+
+    missing_list is an optional list of indices with missing sums, as
+    written by nbrmixer-sum-all.  If sent, only chunks holding these
+    indices are written, instead of checking for each sums file
+
+    By default the chunks are contiguous ranges with equal numbers of
+    indices.  If cost is sent, the indices are packed into chunks with
+    balanced cost, see nbrmixer.chunking
+
+    If ncores is greater than one, the indices for each chunk are split
+    among ncores nbrmixer-fit-m-c processes that run concurrently
+    """
     def __init__(self, run, system, select_conf, nchunks,
-                 missing=False, extra_commands=''):
+                 missing=False, extra_commands='', missing_list=None,
+                 array=False, nproc=None, retries=0, cost=None,
+                 ncores=1):
 
         super(SummerScriptWriter,self).__init__(
             run,
             system,
             missing=missing,
             extra_commands=extra_commands,
+            array=array,
+            nproc=nproc,
+            retries=retries,
+            cost=cost,
+            ncores=ncores,
         )
 
         self['nchunks'] = nchunks
-        self.select_conf=select_conf
+
+        if missing_list is not None:
+            self.missing=True
+            self.missing_list=set(missing_list)
+        else:
+            self.missing_list=None
+
+        self.select_list = selection.parse_list(select_conf)
+        if self.select_list is None:
+            self.select_list = [None]
+
+        self.select_conf=get_select_set_name(select_conf)
         if select_conf is not None:
             self['select_string'] = '--select="%s"' % select_conf
         else:
@@ -278,27 +1161,89 @@ class SummerScriptWriter(ScriptWriter):
         write the basic bash scripts and queue submission scripts
         """
 
-        chunker = Chunker(self['njobs'], self['nchunks'])
-        for i,chunkdef in enumerate(Chunker(self['njobs'], self['nchunks'])):
+        if self.missing:
+            self['force']=''
+        else:
+            self['force']='--force'
+
+        if self['system'] == 'local':
+            return self._run_local(self._write_stage_scripts())
+
+        if self.array and self['system'] == 'lsf':
+            for type, jobs in self._write_stage_scripts():
+                self._write_lsf_array(jobs, type=type)
+            return
+
+        for i,indices in enumerate(self._get_chunks()):
             if self['system'] == 'wq':
-                self._write_wq(i)
+                self._write_wq(i,indices)
 
             elif self['system'] == 'lsf':
-                self._write_lsf(i,chunkdef)
+                self._write_lsf(i,indices)
 
             else:
                 raise RuntimeError("bad system: '%s'" % self['system'])
 
-            self._write_script(i, chunkdef)
+            self._write_script(i, indices)
 
-    def _write_script(self, index, chunkdef):
+    def _get_chunks(self):
+        """
+        get the list of indices for each chunk
+        """
+        if self.cost is None:
+            return [
+                list(xrange(start,end+1))
+                for start,end in Chunker(self['njobs'], self['nchunks'])
+            ]
+        else:
+            return chunking.balanced_chunks(
+                self._get_costs(),
+                self['nchunks'],
+            )
 
-        start,end=chunkdef
+    def _write_stage_scripts(self):
+        """
+        write the bash scripts and get the jobs, as a single stage
+        """
+        jobs=[]
+        for i,indices in enumerate(self._get_chunks()):
+            self._write_script(i, indices)
 
-        self['start'] = start
-        self['end'] = end
+            jobs.append({
+                'index':i,
+                'script':files.get_summer_script_file(
+                    self['run'],
+                    self.select_conf,
+                    i,
+                ),
+                'logfile':files.get_summer_log_file(
+                    self['run'],
+                    self.select_conf,
+                    i,
+                ),
+                'done':self.missing and self._chunk_done(indices),
+            })
 
-        text=_summer_script_template % self
+        return [ ('sum-%s' % self.select_conf, jobs) ]
+
+    def _chunk_done(self, indices):
+        """
+        check if the sums are done for all the indices
+        """
+        if self.missing_list is not None:
+            return not any(
+                i in self.missing_list for i in indices
+            )
+        else:
+            return self._check_sums(indices)
+
+    def _write_script(self, index, indices):
+
+        if self['ncores'] > 1 and len(indices) > 1:
+            text=self._get_multi_script_text(index, indices)
+        else:
+            self['index_option'] = get_index_option(indices)
+            text=_summer_script_template % self
 
         script_fname=files.get_summer_script_file(
             self['run'],
@@ -308,12 +1253,88 @@ class SummerScriptWriter(ScriptWriter):
         with open(script_fname, 'w') as fobj:
             fobj.write(text)
 
-    def _write_lsf(self, index, chunkdef):
+    def _get_multi_script_text(self, index, indices):
         """
-        write the lsf submission script
+        script that splits the indices among ncores concurrent
+        processes, each with its own scratch directory and log
         """
 
-        start,end=chunkdef
+        costs = self._get_costs()
+        worker_chunks = chunking.balanced_chunks(
+            [costs[i] for i in indices],
+            self['ncores'],
+        )
+
+        logfile = files.get_summer_log_file(
+            self['run'],
+            self.select_conf,
+            index,
+        )
+
+        commands=[]
+        for iworker, members in enumerate(worker_chunks):
+            windices = [indices[i] for i in members]
+            commands.append(_summer_worker_template % {
+                'run':self['run'],
+                'select_string':self['select_string'],
+                'force':self['force'],
+                'index_option':get_index_option(windices),
+                'worker':iworker,
+                'logfile':logfile.replace('.log','-worker%d.log' % iworker),
+            })
+
+        return _summer_multi_script_template % {
+            'nworkers':len(worker_chunks),
+            'commands':'\n'.join(commands),
+        }
+
+    def _write_wq(self, index, indices):
+        """
+        write the wq submission script
+        """
+
+        wq_dir = files.get_wq_dir(self['run'])
+        if not os.path.exists(wq_dir):
+            os.makedirs(wq_dir)
+
+        wq_fname=files.get_summer_wq_file(
+            self['run'],
+            self.select_conf,
+            index,
+        )
+
+        if self.missing:
+            wq_fname = wq_fname.replace('.yaml','-missing.yaml')
+
+            if self._chunk_done(indices):
+                self._remove(wq_fname)
+                return
+
+        job_name = os.path.basename(wq_fname)
+        job_name = job_name.replace('.yaml','')
+
+        self['job_name'] = job_name
+        self['logfile']  = files.get_summer_log_file(
+            self['run'],
+            self.select_conf,
+            index,
+        )
+        self['script']   = files.get_summer_script_file(
+            self['run'],
+            self.select_conf,
+            index,
+        )
+
+        text = _wq_template  % self
+
+        print("writing:",wq_fname)
+        with open(wq_fname,'w') as fobj:
+            fobj.write(text)
+
+    def _write_lsf(self, index, indices):
+        """
+        write the lsf submission script
+        """
 
         lsf_dir = files.get_lsf_dir(self['run'])
         if not os.path.exists(lsf_dir):
@@ -326,35 +1347,20 @@ class SummerScriptWriter(ScriptWriter):
         )
         submitted_fname = lsf_fname.replace('.lsf','.lsf.submitted')
 
-        if os.path.exists(lsf_fname):
-            os.remove(lsf_fname)
-        if os.path.exists(submitted_fname):
-            os.remove(submitted_fname)
+        self._remove(lsf_fname)
+        self._remove(submitted_fname)
 
 
         if self.missing:
-            self['force']=''
-            all_ok=True
             lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
             submitted_fname = lsf_fname.replace('.lsf','.lsf.submitted')
 
 
-            if os.path.exists(submitted_fname):
-                os.remove(submitted_fname)
-            if os.path.exists(lsf_fname):
-                os.remove(lsf_fname)
-
-            for i in xrange(start,end+1):
-                sums_file = files.get_sums_file(
-                    self['run'],
-                    extra=self.select_conf,
-                    index=i,
-                )
+            self._remove(submitted_fname)
+            self._remove(lsf_fname)
 
-                if not os.path.exists(sums_file):
-                    all_ok=False
+            all_ok = self._chunk_done(indices)
         else:
-            self['force']='--force'
             all_ok=False
 
 
@@ -385,6 +1391,65 @@ class SummerScriptWriter(ScriptWriter):
         with open(lsf_fname,'w') as fobj:
             fobj.write(text)
 
+    def _get_status(self):
+        """
+        get the table of existing sums files, listing the directory
+        on first use
+        """
+        if self._status is None:
+            print("scanning sums for run:",self['run'])
+            self._status = status.RunStatus(
+                self['run'],
+                self['njobs'],
+                outputs=False,
+            )
+        return self._status
+
+    def _get_costs(self):
+        """
+        get the cost estimate for each index, all equal if no cost
+        type was sent
+        """
+        if self._costs is None:
+            if self.cost is None:
+                self._costs = [1.0]*self['njobs']
+            else:
+                if self.cost in ['size','nrows']:
+                    st = status.RunStatus(
+                        self['run'],
+                        self['njobs'],
+                        means=False,
+                        scripts=False,
+                    )
+                else:
+                    st = None
+
+                self._costs = chunking.get_costs(
+                    self['run'],
+                    self['njobs'],
+                    self.cost,
+                    status=st,
+                )
+
+        return self._costs
+
+    def _check_sums(self, indices):
+        """
+        check if all sums files exist for the indices
+        """
+        for i in indices:
+            for select in self.select_list:
+                sums_file = files.get_sums_file(
+                    self['run'],
+                    extra=select,
+                    index=i,
+                )
+
+                if not self._get_status().exists(sums_file):
+                    return False
+
+        return True
+
     def _makedirs(self):
         """
         make all the directories needed
@@ -392,6 +1457,83 @@ class SummerScriptWriter(ScriptWriter):
         pass
 
 
+def get_select_set_name(select_conf):
+    """
+    name used in file names for a set of selections
+
+    A single select config is used as is, while a comma separated list
+    gets a name based on a hash of the list
+    """
+    import hashlib
+
+    select_list = selection.parse_list(select_conf)
+    if select_list is None or len(select_list) == 1:
+        return select_conf
+
+    h = hashlib.md5(','.join(select_list).encode('utf-8')).hexdigest()
+    return 'multi-%s' % h[:8]
+
+def get_lsf_condition(job):
+    """
+    get the lsf -w dependency condition for a pipeline job, or None if
+    it has no dependencies
+
+    Jobs that depend on all jobs in some stages use wildcard patterns,
+    to keep the condition short
+    """
+
+    if job.get('depend_patterns'):
+        conds = ['ended(%s)' % p for p in job['depend_patterns']]
+    elif len(job['deps']) > 0:
+        if job.get('after_any',False):
+            op='ended'
+        else:
+            op='done'
+        conds = ['%s(%s)' % (op, d) for d in job['deps']]
+    else:
+        return None
+
+    return ' && '.join(conds)
+
+def get_array_spec(elements):
+    """
+    compact lsf job array specification, e.g. 1-5,9,12-20
+
+    parameters
+    ----------
+    elements: list
+        Sorted list of array elements
+    """
+    ranges=[]
+    start=prev=elements[0]
+    for el in elements[1:]:
+        if el != prev+1:
+            ranges.append( (start,prev) )
+            start=el
+        prev=el
+
+    ranges.append( (start,prev) )
+
+    spec=[]
+    for start,end in ranges:
+        if start == end:
+            spec.append('%d' % start)
+        else:
+            spec.append('%d-%d' % (start,end))
+
+    return ','.join(spec)
+
+def get_index_option(indices):
+    """
+    get the nbrmixer-fit-m-c option for the indices, a range if they
+    are contiguous, otherwise a list
+    """
+    indices = sorted(indices)
+    if indices[-1]-indices[0] == len(indices)-1:
+        return '--index-range=%d,%d' % (indices[0], indices[-1])
+    else:
+        return '--index-list=%s' % ','.join(['%d' % i for i in indices])
+
 def Chunker(num, nchunks):
 
     nper = num//nchunks
@@ -458,18 +1600,74 @@ python -u $(which ngmixit)    \
 _summer_script_template = r"""#!/bin/bash
 # set up environment before running this script
 
-start=%(start)d
-end=%(end)d
+nbrmixer-fit-m-c                \
+        %(run)s                 \
+        %(select_string)s       \
+        %(index_option)s %(force)s
+"""
+
+
 
-for index in $(seq $start $end); do
-    nbrmixer-fit-m-c          \
-            %(run)s           \
-            %(select_string)s \
-            --index=$index %(force)s
+_summer_multi_script_template = r"""#!/bin/bash
+# set up environment before running this script
+#
+# the indices are split among %(nworkers)d processes that run
+# concurrently, each in its own scratch directory and with its own log
+
+scratch="${TMPDIR:-/tmp}"
+
+pids=()
+
+%(commands)s
+
+nfail=0
+for pid in ${pids[@]}; do
+    wait $pid || nfail=$((nfail+1))
 done
+
+if [[ $nfail != "0" ]]; then
+    echo "$nfail workers failed"
+    exit 1
+fi
+"""
+
+_summer_worker_template = r"""workdir="$scratch/worker-%(worker)d"
+mkdir -p "$workdir"
+(
+    cd "$workdir"
+    export TMPDIR="$workdir"
+    nbrmixer-fit-m-c                \
+            %(run)s                 \
+            %(select_string)s       \
+            %(index_option)s %(force)s
+) &> "%(logfile)s" &
+pids+=($!)
+"""
+
+_collate_script_template = r"""#!/bin/bash
+# set up environment before running this script
+
+nbrmixer-collate %(run)s
+"""
+
+_sum_all_script_template = r"""#!/bin/bash
+# set up environment before running this script
+
+nbrmixer-sum-all %(run)s %(select)s
+"""
+
+_lsf_pipeline_submit_template = r"""#!/bin/bash
+# submit the pipeline jobs in order, so the jobs named in each
+# dependency condition already exist
+
+%(commands)s
 """
 
+_merge_script_template = r"""#!/bin/bash
+# set up environment before running this script
 
+nbrmixer-merge-splits %(run)s %(index)d %(nsplit)d
+"""
 
 _mofsub_script_template = r"""#!/bin/bash
 # set up environment before running this script
@@ -479,10 +1677,11 @@ meds_file="%(meds_file)s"
 mof_file="%(mof_file)s"
 output_file="%(output_file)s"
 
-meds_base=$(basename $meds_file)
-meds_local="$TMPDIR/$meds_base"
-
-/bin/cp -fv "$meds_file" "$meds_local"
+# stage the MEDS file to the node-local cache, shared with the other
+# jobs on the node, holding a reference until this script exits.  Fail
+# rather than run the fitter with an empty path
+meds_local=$(nbrmixer-cache --holder $$ acquire "$meds_file") || exit 1
+trap 'nbrmixer-cache --holder $$ release "$meds_file"' EXIT
 
 python -u $(which ngmixit)    \
     --work-dir=$TMPDIR        \
@@ -491,9 +1690,6 @@ python -u $(which ngmixit)    \
     $output_file              \
     $meds_local
 
-rm -v "$meds_local"
-
-
 """
 
 
@@ -506,21 +1702,24 @@ fof_file="%(fof_file)s"
 nbrs_file="%(nbrs_file)s"
 output_file="%(output_file)s"
 
-meds_base=$(basename $meds_file)
-meds_local="$TMPDIR/$meds_base"
+start=%(start)d
+end=%(end)d
 
-/bin/cp -fv "$meds_file" "$meds_local"
+# stage the MEDS file to the node-local cache, shared with the other
+# jobs on the node, holding a reference until this script exits.  Fail
+# rather than run the fitter with an empty path
+meds_local=$(nbrmixer-cache --holder $$ acquire "$meds_file") || exit 1
+trap 'nbrmixer-cache --holder $$ release "$meds_file"' EXIT
 
 python -u $(which ngmixit)    \
     --work-dir=$TMPDIR        \
     --fof-file="$fof_file"    \
     --nbrs-file="$nbrs_file"  \
+    --fof-range=$start,$end   \
     $config_file              \
     $output_file              \
     $meds_local
 
-rm -v "$meds_local"
-
 """
 
 
@@ -532,17 +1731,86 @@ meds_file="%(meds_file)s"
 fof_file="%(fof_file)s"
 nbrs_file="%(nbrs_file)s"
 
+# stage the MEDS file to the node-local cache, shared with the other
+# jobs on the node, holding a reference until this script exits.  Fail
+# rather than run the fitter with an empty path
+meds_local=$(nbrmixer-cache --holder $$ acquire "$meds_file") || exit 1
+trap 'nbrmixer-cache --holder $$ release "$meds_file"' EXIT
+
 ngmixer-meds-make-nbrs-data    \
     --fof-file="$fof_file"     \
     --nbrs-file="$nbrs_file"   \
     "$config_file"             \
-    "$meds_file"
+    "$meds_local"
 """
 
 
+_chunk_script_template = r"""#!/bin/bash
+# run a packed set of jobs, up to %(ncores)d at a time, each in its own
+# scratch directory and with its own log
+
+maxjobs=%(ncores)d
+scratch="${TMPDIR:-/tmp}"
+
+# the jobs share the MEDS cache rather than each using its own scratch
+export NBRMIXER_CACHE_DIR="${NBRMIXER_CACHE_DIR:-$scratch/nbrmixer-cache}"
+
+run_job() {
+    local script="$1"
+    local logfile="$2"
+    local workdir="$3"
+
+    mkdir -p "$workdir"
+    local tmp_logfile="$workdir/$(basename $logfile)"
+
+    echo "running: $script"
+    (cd "$workdir" && TMPDIR="$workdir" /usr/bin/time bash "$script") &> "$tmp_logfile"
+    local status=$?
+
+    mv -f "$tmp_logfile" "$logfile"
+    rm -rf "$workdir"
+
+    if [[ $status != "0" ]]; then
+        echo "failed: $script"
+    fi
+    return $status
+}
+
+nfail=0
+nrunning=0
+
+wait_one() {
+    wait -n || nfail=$((nfail+1))
+    nrunning=$((nrunning-1))
+}
+
+submit() {
+    if [[ $nrunning -ge $maxjobs ]]; then
+        wait_one
+    fi
+    run_job "$@" &
+    nrunning=$((nrunning+1))
+}
+
+%(commands)s
+
+while [[ $nrunning -gt 0 ]]; do
+    wait_one
+done
+
+if [[ $nfail != "0" ]]; then
+    echo "$nfail jobs failed"
+    exit 1
+fi
+"""
+
+_chunk_command_template = r"""submit "%(script)s" "%(logfile)s" "$scratch/%(name)s"
+"""
+
 _lsf_template = """#!/bin/bash
 #BSUB -J %(job_name)s
-#BSUB -n 1
+#BSUB -n %(ncores)d
+#BSUB -R "span[hosts=1]"
 #BSUB -oo ./%(job_name)s.oe
 #BSUB -W 12:00
 #BSUB -R "linux64 && rhel60 && scratch > 2"
@@ -551,6 +1819,7 @@ echo "working on host: $(hostname)"
 uptime
 
 export tmpdir="/scratch/esheldon/${LSB_JOBID}"
+export NBRMIXER_CACHE_DIR="${NBRMIXER_CACHE_DIR:-/scratch/esheldon/nbrmixer-cache}"
 export TMPDIR="$tmpdir"
 
 mkdir -p ${tmpdir}
@@ -562,10 +1831,53 @@ tmp_logfile="$(basename $logfile)"
 tmp_logfile="$tmpdir/$tmp_logfile"
 
 /usr/bin/time bash %(script)s &> "$tmp_logfile"
+status=$?
+
+mv -vf "$tmp_logfile" "$logfile"
+
+rm -r $tmpdir
+
+# so LSF records the job as failed, and done() dependencies are not met
+exit $status
+"""
+
+_lsf_array_template = """#!/bin/bash
+#BSUB -J %(job_name)s[%(array_spec)s]
+#BSUB -n %(ncores)d
+#BSUB -R "span[hosts=1]"
+#BSUB -oo ./%(job_name)s.%%I.oe
+#BSUB -W 12:00
+#BSUB -R "linux64 && rhel60 && scratch > 2"
+
+echo "working on host: $(hostname)"
+uptime
+
+# each line of the map holds the script and log file for an array element
+index_map="%(index_map)s"
+line=$(sed -n "${LSB_JOBINDEX}p" "$index_map")
+read script logfile <<< "$line"
+
+export tmpdir="/scratch/esheldon/${LSB_JOBID}_${LSB_JOBINDEX}"
+export NBRMIXER_CACHE_DIR="${NBRMIXER_CACHE_DIR:-/scratch/esheldon/nbrmixer-cache}"
+export TMPDIR="$tmpdir"
+
+mkdir -p ${tmpdir}
+echo "cd $tmpdir"
+cd $tmpdir
+
+tmp_logfile="$(basename $logfile)"
+tmp_logfile="$tmpdir/$tmp_logfile"
+
+/usr/bin/time bash "$script" &> "$tmp_logfile"
+status=$?
 
 mv -vf "$tmp_logfile" "$logfile"
 
 rm -r $tmpdir
+
+# so LSF records the element as failed, e.g. when an index in a
+# packed chunk failed
+exit $status
 """
 
 _wq_template = """#!/bin/bash
@@ -0,0 +1,181 @@
+"""
+selections and the columns they need
+
+Column lists are given as glob style patterns, e.g. 'mcal_g*', which are
+matched against the columns available in a file
+"""
+from __future__ import print_function
+import ast
+import fnmatch
+
+# columns needed for the summer options, keyed by the argument name
+OPTION_COLUMNS={
+    'preselect':['s2n_true'],
+    'corr_psf_orig':['*psf_orig*'],
+    'etype':['mcal_e*'],
+}
+
+# parsed select strings, keyed by the select string
+_parsed_selects={}
+
+def parse_select(select):
+    """
+    get the names used in a select string, cached so each string is
+    only parsed once
+
+    This is only used to find the columns to read; the selection itself
+    is evaluated by nsim in do_sums1
+
+    parameters
+    ----------
+    select: string
+        The select string, e.g. '(s2n > 10) & (data["flags"] == 0)'
+
+    returns
+    -------
+    SelectFields
+    """
+    select = select.strip()
+
+    if select not in _parsed_selects:
+        _parsed_selects[select] = SelectFields(select)
+
+    return _parsed_selects[select]
+
+class SelectFields(object):
+    """
+    the names used in a select string
+
+    The string is parsed to find the data fields it references, as
+    data["field"], and the other names it uses, such as s2n or Tratio.
+
+    parameters
+    ----------
+    select: string
+        The select string
+    """
+    def __init__(self, select):
+        self.select = select.strip()
+
+        self._parse()
+
+    def _parse(self):
+        """
+        find the fields and other names used
+        """
+
+        tree = ast.parse(self.select, mode='eval')
+
+        fields=set()
+        names=set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Subscript):
+                field = _get_data_field(node)
+                if field is not None:
+                    fields.add(field)
+
+            elif isinstance(node, ast.Name) and node.id != 'data':
+                names.add(node.id)
+
+        self.fields = sorted(fields)
+        self.names = sorted(names)
+
+def get_select_fields(select):
+    """
+    get the data fields referenced in a select string
+
+    returns
+    -------
+    fields, names: lists
+        fields referenced as data["field"], and other bare names
+        that could be derived quantities
+    """
+    if select is None:
+        return [], []
+
+    sel = parse_select(select)
+    return sel.fields, sel.names
+
+def get_option_patterns(args):
+    """
+    get the column patterns needed for the options that are set in the
+    parsed arguments
+    """
+    patterns=[]
+    for name in sorted(OPTION_COLUMNS):
+        if getattr(args, name, False):
+            patterns += OPTION_COLUMNS[name]
+
+    return patterns
+
+def match_columns(available, patterns, required=None):
+    """
+    get the available columns matching any of the patterns, in the order
+    they appear in available
+
+    parameters
+    ----------
+    available: list
+        Available column names
+    patterns: list or None
+        Glob style patterns.  If None, all available columns are returned
+    required: list, optional
+        Names that must be present in the available columns
+
+    returns
+    -------
+    columns: list
+    """
+
+    available = list(available)
+
+    if required is not None:
+        for name in required:
+            if name not in available:
+                raise ValueError("required column '%s' is missing" % name)
+
+    if patterns is None:
+        return available
+
+    patterns = list(patterns)
+    if required is not None:
+        patterns += list(required)
+
+    return [
+        c for c in available
+        if any(fnmatch.fnmatchcase(c, p) for p in patterns)
+    ]
+
+def parse_list(vals):
+    """
+    parse a comma separated list, e.g. of column patterns
+
+    A list is returned unchanged, and None is returned for None
+    """
+    if vals is None:
+        return None
+
+    if isinstance(vals, (list,tuple)):
+        return list(vals)
+
+    return [v.strip() for v in vals.split(',') if v.strip() != '']
+
+def _get_data_field(node):
+    """
+    get the field name for data["field"], or None for other subscripts
+    """
+    if not isinstance(node.value, ast.Name) or node.value.id != 'data':
+        return None
+
+    index = node.slice
+    if hasattr(ast, 'Index') and isinstance(index, ast.Index):
+        # python < 3.9
+        index = index.value
+
+    if hasattr(ast, 'Constant'):
+        if isinstance(index, ast.Constant) and isinstance(index.value, str):
+            return index.value
+    elif isinstance(index, ast.Str):
+        return index.s
+
+    return None
@@ -0,0 +1,163 @@
+"""
+split the processing of a MEDS file into ranges of FoF groups
+
+Each range is processed by a separate job writing its own output file.
+The outputs are then merged, in order, into the usual output file for the
+index, which is what nbrmixer-collate expects.
+"""
+from __future__ import print_function
+try:
+    xrange
+except:
+    xrange=range
+
+import os
+import re
+
+from . import files
+
+# header keywords describing the structure of an HDU, which are written
+# by fitsio and should not be copied
+_structural_regex = re.compile(
+    r'^(SIMPLE|BITPIX|NAXIS\d*|EXTEND|XTENSION|PCOUNT|GCOUNT|TFIELDS|'
+    r'EXTNAME|EXTVER|CHECKSUM|DATASUM|ZIMAGE|ZBITPIX|ZNAXIS\d*|ZTILE\d*|'
+    r'ZCMPTYPE|(TTYPE|TFORM|TUNIT|TDIM|TNULL|TSCAL|TZERO|TDISP)\d+)$'
+)
+
+def get_split_ranges(nfof, split_size):
+    """
+    get the FoF ranges for the splits
+
+    parameters
+    ----------
+    nfof: int
+        Number of FoF groups; for MEDS files without a FoF file, each
+        object is its own group
+    split_size: int
+        Max number of FoF groups in each split
+
+    returns
+    -------
+    ranges: list
+        List of (start,end) inclusive
+    """
+    if split_size <= 0:
+        raise ValueError("split size must be positive, got %d" % split_size)
+
+    ranges=[]
+    for start in xrange(0, nfof, split_size):
+        end = min(start+split_size, nfof)-1
+        ranges.append( (start,end) )
+
+    return ranges
+
+def get_nfof(meds_file, fof_file=None):
+    """
+    get the number of FoF groups, from the FoF file if sent, otherwise
+    the number of objects in the MEDS file
+
+    returns None if the file does not exist
+    """
+    import numpy
+    import fitsio
+
+    try:
+        if fof_file is not None:
+            fofs = fitsio.read(fof_file, columns=['fofid'])
+            return numpy.unique(fofs['fofid']).size
+        else:
+            h = fitsio.read_header(meds_file, ext='object_data')
+            return h['NAXIS2']
+    except (IOError, OSError):
+        return None
+
+def merge_splits(run, index, nsplit, remove=True):
+    """
+    merge the outputs for the FoF ranges into the output file for the
+    index
+
+    Tables are concatenated in split order, and images and the header
+    keys are taken from the first split.  The output is written to a temporary file and
+    renamed into place
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    index: int
+        output index
+    nsplit: int
+        Number of splits
+    remove: bool, optional
+        If True, remove the split outputs after merging
+    """
+    import fitsio
+
+    fnames = [
+        files.get_split_output_file(run, index, split)
+        for split in xrange(nsplit)
+    ]
+    missing = [f for f in fnames if not os.path.exists(f)]
+    if len(missing) > 0:
+        raise IOError("missing split outputs: %s" % ', '.join(missing))
+
+    output_file = files.get_output_file(run, index)
+    tmp_file = output_file.replace('.fits','-merge-tmp.fits')
+    print("merging %d splits into: %s" % (nsplit, output_file))
+
+    try:
+        # ignore_empty allows empty image hdus after the primary
+        with fitsio.FITS(tmp_file,'rw',clobber=True,
+                         ignore_empty=True) as output:
+            with fitsio.FITS(fnames[0]) as first:
+                for ext in xrange(len(first)):
+                    _merge_hdu(output, first[ext], fnames, ext)
+
+        os.rename(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    if remove:
+        for fname in fnames:
+            print("removing:",fname)
+            os.remove(fname)
+
+def _merge_hdu(output, hdu, fnames, ext):
+    """
+    write the hdu to the output, with table rows from all files
+
+    Image hdus with no data, including the primary, are written empty
+    """
+    import fitsio
+
+    extname = hdu.get_extname()
+    if extname == '':
+        extname = None
+
+    records = _get_header_records(hdu.read_header())
+
+    if hdu.get_exttype() == 'IMAGE_HDU':
+        if hdu.has_data():
+            data = hdu.read()
+        else:
+            data = None
+
+        output.write(data, extname=extname)
+        output[-1].write_keys(records)
+        return
+
+    for i, fname in enumerate(fnames):
+        if i == 0:
+            data = hdu.read()
+            output.write(data, extname=extname)
+            output[-1].write_keys(records)
+        else:
+            data = fitsio.read(fname, ext=ext)
+            output[-1].append(data)
+
+def _get_header_records(header):
+    return [
+        r for r in header.records()
+        if r['name'] and not _structural_regex.match(r['name'])
+    ]
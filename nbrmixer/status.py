@@ -0,0 +1,204 @@
+"""
+status of the products for a run
+
+The output directories and the fit-m-c directory are listed in bulk, rather
+than checking each product with a separate os.path.exists, which is a
+metadata round trip on a network file system.  The listings can be done
+with a pool of threads.  Only the names are kept from the listings; the
+sizes and mtimes are read with a stat the first time they are asked for.
+"""
+from __future__ import print_function
+try:
+    xrange
+except:
+    xrange=range
+
+import os
+
+from . import files
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir=None
+
+# default number of threads used to list directories
+DEFAULT_NTHREADS=8
+
+class RunStatus(object):
+    """
+    table of the files that exist for a run
+
+    The sizes and mtimes are read when first used, so the scan does not
+    stat every file
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    njobs: int
+        Number of output indices
+    nthreads: int, optional
+        Number of threads used to list the directories
+    outputs: bool, optional
+        If True, list the output directories
+    means: bool, optional
+        If True, list the fit-m-c directory holding the sums
+    scripts: bool, optional
+        If True, list the directory holding the queue submission scripts
+    """
+    def __init__(self, run, njobs, nthreads=DEFAULT_NTHREADS,
+                 outputs=True, means=True, scripts=True):
+        self.run=run
+        self.njobs=njobs
+        self.nthreads=nthreads
+
+        self._table={}
+        self._dirs=set()
+
+        self._scan(outputs, means, scripts)
+
+    def exists(self, fname):
+        """
+        check if the file exists
+        """
+        return fname in self._table
+
+    def dir_exists(self, dir):
+        """
+        check if the directory exists and was listed
+        """
+        return dir in self._dirs
+
+    def get_size(self, fname):
+        """
+        get the size of the file in bytes, or None if it does not exist
+        """
+        st = self._stat(fname)
+        if st is None:
+            return None
+        return st.st_size
+
+    def get_mtime(self, fname):
+        """
+        get the mtime of the file, or None if it does not exist
+        """
+        st = self._stat(fname)
+        if st is None:
+            return None
+        return st.st_mtime
+
+    def _stat(self, fname):
+        """
+        stat a listed file on first use, caching the result
+        """
+        if fname not in self._table:
+            return None
+
+        st = self._table[fname]
+        if st is None:
+            try:
+                st = os.stat(fname)
+            except OSError:
+                # removed since the listing
+                del self._table[fname]
+                return None
+
+            self._table[fname] = st
+
+        return st
+
+    def _scan(self, outputs, means, scripts):
+        """
+        list the output directories, the fit-m-c dir and the
+        submission script dir
+        """
+
+        dirs=[]
+        if outputs:
+            output_dirs = [
+                files.get_output_dir(self.run, i) for i in xrange(self.njobs)
+            ]
+
+            # only list the index dirs that exist, from one listing of
+            # the parent
+            parents = set([os.path.dirname(d) for d in output_dirs])
+            present=set()
+            for parent in parents:
+                present.update(
+                    [os.path.join(parent, n) for n in listdir(parent)]
+                )
+
+            dirs += [d for d in output_dirs if d in present]
+
+        if means:
+            dirs.append(files.get_means_dir(self.run))
+
+        if scripts:
+            dirs.append(files.get_lsf_dir(self.run))
+
+        for dir, names in self._iter_listings(dirs):
+            if names is None:
+                continue
+
+            self._dirs.add(dir)
+            for name in names:
+                self._table[os.path.join(dir, name)] = None
+
+    def _iter_listings(self, dirs):
+        if self.nthreads > 1 and len(dirs) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(processes=self.nthreads)
+            try:
+                for res in pool.imap_unordered(_list_dir, dirs, chunksize=16):
+                    yield res
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for dir in dirs:
+                yield _list_dir(dir)
+
+def listdir(dir):
+    """
+    list the names in a directory, or an empty list if it does not exist
+    """
+    try:
+        return os.listdir(dir)
+    except OSError:
+        return []
+
+def _list_dir(dir):
+    """
+    get the names of the files in the directory
+
+    With scandir, directories are skipped using the type from the listing,
+    which needs no stat on most file systems
+
+    returns
+    -------
+    dir, names
+        names is None if the directory does not exist
+    """
+    try:
+        if scandir is not None:
+            names=[]
+            for entry in scandir(dir):
+                try:
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                names.append(entry.name)
+        else:
+            names=os.listdir(dir)
+    except OSError:
+        return dir, None
+
+    return dir, names
@@ -0,0 +1,285 @@
+"""
+combine the per-index sums files
+
+The indices are split into blocks, and a partial reduction is written for
+each block, recording which files went into it and their mtimes.  A block
+is only re-read when its set of files changed, so re-adding a few
+recomputed indices only re-reads their blocks.  The blocks are reduced in
+parallel and then merged pairwise.
+"""
+from __future__ import print_function
+try:
+    xrange
+except:
+    xrange=range
+
+import os
+import json
+import numpy
+import fitsio
+
+from . import files
+
+
+class SumsReducer(object):
+    """
+    add up the per-index sums files for a run and selection
+
+    parameters
+    ----------
+    run: string
+        run identifier
+    select: string
+        The select config name, used in the sums file names
+    njobs: int
+        Number of output files for the run
+    nproc: int, optional
+        Number of processes used to reduce the blocks
+    blocksize: int, optional
+        Number of indices in each partial reduction
+    """
+    def __init__(self, run, select, njobs, nproc=1, blocksize=100):
+        self.run=run
+        self.select=select
+        self.njobs=njobs
+        self.nproc=nproc
+        self.blocksize=blocksize
+
+    def go(self):
+        """
+        reduce the sums and write the total
+
+        returns
+        -------
+        sums, missing
+            The total sums and list of indices with no sums file
+        """
+
+        sums_file = files.get_sums_file(
+            self.run,
+            extra=self.select,
+        )
+        print("will write to:",sums_file)
+
+        partials=[]
+        missing=[]
+        for block, bsums, bmissing in self._iter_blocks():
+            if bsums is not None:
+                partials.append(bsums)
+            missing += bmissing
+
+        missing.sort()
+        print("%d/%d were missing" % (len(missing),self.njobs))
+        self._write_missing(missing)
+
+        if len(partials) == 0:
+            raise IOError("no sums files found")
+
+        sums = tree_sum(partials)
+
+        print("writing:",sums_file)
+        fitsio.write(sums_file, sums, clobber=True)
+
+        return sums, missing
+
+    def _iter_blocks(self):
+        jobs = self._get_jobs()
+
+        if self.nproc > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes=self.nproc)
+            try:
+                # in block order, so the float sums do not depend on
+                # which worker finishes first
+                for res in pool.imap(reduce_block, jobs):
+                    yield res
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for job in jobs:
+                yield reduce_block(job)
+
+    def _get_jobs(self):
+        jobs=[]
+        nblocks = (self.njobs + self.blocksize - 1)//self.blocksize
+        for block in xrange(nblocks):
+            start = block*self.blocksize
+            end = min(start+self.blocksize, self.njobs)
+            jobs.append({
+                'run':self.run,
+                'select':self.select,
+                'block':block,
+                'indices':list(xrange(start,end)),
+            })
+
+        return jobs
+
+    def _write_missing(self, missing):
+        """
+        write the missing indices, for use in generating scripts
+        """
+        fname = files.get_sums_missing_file(self.run, extra=self.select)
+        print("writing missing list:",fname)
+
+        data = {
+            'run':self.run,
+            'select':self.select,
+            'njobs':self.njobs,
+            'missing':missing,
+        }
+        with open(fname,'w') as fobj:
+            json.dump(data, fobj, indent=1)
+
+def reduce_block(job):
+    """
+    reduce the sums files for a block of indices, reusing the partial
+    reduction if the files are unchanged
+
+    parameters
+    ----------
+    job: dict
+        Dict with entries run, select, block and indices
+
+    returns
+    -------
+    block, sums, missing
+        sums is None if there were no files
+    """
+    run=job['run']
+    select=job['select']
+    block=job['block']
+
+    present=[]
+    missing=[]
+    for index in job['indices']:
+        fname = files.get_sums_file(run, extra=select, index=index)
+        try:
+            st = os.stat(fname)
+        except OSError:
+            print("missing:",fname)
+            missing.append(index)
+            continue
+
+        present.append( (index, st.st_mtime) )
+
+    if len(present) == 0:
+        return block, None, missing
+
+    partial_file = files.get_partial_sums_file(run, block, extra=select)
+
+    info = numpy.zeros(len(present), dtype=[('index','i8'),('mtime','f8')])
+    info['index'] = [p[0] for p in present]
+    info['mtime'] = [p[1] for p in present]
+
+    sums = _read_partial(partial_file, info)
+    if sums is not None:
+        print("reusing:",partial_file)
+        return block, sums, missing
+
+    sums_list=[]
+    for index in info['index']:
+        fname = files.get_sums_file(run, extra=select, index=index)
+        print("reading:",fname)
+        sums_list.append( fitsio.read(fname) )
+
+    sums = tree_sum(sums_list)
+
+    print("writing:",partial_file)
+    with fitsio.FITS(partial_file,'rw',clobber=True) as fits:
+        fits.write(sums, extname='sums')
+        fits.write(info, extname='info')
+
+    return block, sums, missing
+
+def tree_sum(sums_list):
+    """
+    add up the sums pairwise
+
+    parameters
+    ----------
+    sums_list: list
+        List of sums arrays, all with the same dtype and shape
+
+    returns
+    -------
+    sums: array
+        A new array with the total
+    """
+    if len(sums_list) == 0:
+        raise ValueError("no sums to add")
+
+    level = list(sums_list)
+    while len(level) > 1:
+        next_level=[]
+        for i in xrange(0, len(level)-1, 2):
+            next_level.append( add_sums(level[i].copy(), level[i+1]) )
+
+        if len(level) % 2 == 1:
+            next_level.append(level[-1])
+
+        level = next_level
+
+    return level[0].copy()
+
+def add_sums(sums, tsums):
+    """
+    add the sums in tsums to sums, returning a new array if
+    sums is None
+
+    the dtypes and shapes must match, apart from byte order, since sums
+    read back with fitsio are big endian
+    """
+    if sums is None:
+        return tsums.copy()
+
+    if (_native_dtype(sums.dtype) != _native_dtype(tsums.dtype)
+            or sums.shape != tsums.shape):
+        raise ValueError(
+            "sums do not match: %s %s vs %s %s" % (
+                sums.dtype.descr, sums.shape,
+                tsums.dtype.descr, tsums.shape,
+            )
+        )
+
+    for n in sums.dtype.names:
+        sums[n] += tsums[n]
+
+    return sums
+
+def _native_dtype(dtype):
+    """
+    the dtype with all fields in native byte order
+    """
+    return dtype.newbyteorder('=')
+
+def _read_partial(fname, info):
+    """
+    read the partial sums if it was made from the same set of files
+    """
+    if not os.path.exists(fname):
+        return None
+
+    try:
+        with fitsio.FITS(fname) as fits:
+            oldinfo = fits['info'].read()
+            if (oldinfo.size != info.size
+                    or not numpy.all(oldinfo['index'] == info['index'])
+                    or not numpy.all(oldinfo['mtime'] == info['mtime'])):
+                return None
+
+            return fits['sums'].read()
+    except IOError:
+        return None
+
+def read_missing(fname):
+    """
+    read the list of missing indices written by SumsReducer
+    """
+    with open(fname) as fobj:
+        data = json.load(fobj)
+
+    return data['missing']
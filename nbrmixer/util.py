@@ -2,39 +2,165 @@ from __future__ import print_function
 import numpy
 import esutil as eu
 import fitsio
-
-def add_true_shear(data, run, index):
+from . import matching
+
+# columns added from the matched sextractor catalog
+TRUE_SHEAR_DT=[
+    ('sxflags','i4'),
+    ('shear_true','f8',2),
+    ('shear_index','i2'),
+]
+
+# columns added when matching to the truth catalog
+MATCH_DT=TRUE_SHEAR_DT + [
+    ('match_dist','f4'),
+    ('match_ncand','i4'),
+    ('match_ambig','i4'),
+]
+
+# value for rows with no match
+NO_MATCH=-9999
+
+def add_true_shear(data, run, index, out=None):
     """
     get the matched catalog and add the shear
+
+    Rows are joined on number, so the data can be a subset of the catalog
+    in any order.  Rows not in the catalog get NO_MATCH for the new
+    columns, which the shear_index cut in the summer removes
+
+    parameters
+    ----------
+    data: array
+        The outputs, with a number column
+    run: string
+        The nbrsim run
+    index: int
+        The file index
+    out: array, optional
+        Array to fill, with the same size as data and a dtype with the
+        fields of data plus TRUE_SHEAR_DT, e.g. from
+        get_true_shear_dtype.  Default is to make a new one
+
+    returns
+    -------
+    out: array
+        The data with the new columns
     """
     import nbrsim
     matched_file = nbrsim.files.get_sxcat_match_file(run, index)
 
-    matched_data = fitsio.read(matched_file)
+    matched_data = fitsio.read(
+        matched_file,
+        columns=['number','flags','shear_index','shear_true'],
+    )
+
+    if out is None:
+        out = numpy.zeros(data.size, dtype=get_true_shear_dtype(data.dtype))
+    elif out.size != data.size:
+        raise ValueError("output has %d rows, expected %d" % (out.size, data.size))
+
+    eu.numpy_util.copy_fields(data, out)
+
+    ind, mind = join_sorted(data['number'], matched_data['number'])
+
+    nmiss = data.size - ind.size
+    if nmiss > 0:
+        print("    %d/%d rows not found in %s" % (nmiss, data.size, matched_file))
+        out['sxflags']     = NO_MATCH
+        out['shear_index'] = NO_MATCH
+        out['shear_true']  = NO_MATCH
+
+    out['sxflags'][ind]     = matched_data['flags'][mind]
+    out['shear_index'][ind] = matched_data['shear_index'][mind]
+    out['shear_true'][ind]  = matched_data['shear_true'][mind]
+
+    return out
+
+def get_true_shear_dtype(dtype):
+    """
+    get the dtype with the columns added by add_true_shear
+    """
+    return add_dtype_fields(dtype, TRUE_SHEAR_DT)
+
+def get_match_dtype(dtype):
+    """
+    get the dtype with the columns added by match_truth
+    """
+    return add_dtype_fields(dtype, MATCH_DT)
+
+def add_dtype_fields(dtype, add_dt):
+    """
+    get a dtype with the new fields appended, skipping any already
+    present
+    """
+    dtype=numpy.dtype(dtype)
+    descr = [(name, dtype.fields[name][0]) for name in dtype.names]
+    descr += [d for d in add_dt if d[0] not in dtype.names]
+    return numpy.dtype(descr)
+
+def join_sorted(keys, ref_keys):
+    """
+    find the rows of the reference with the same key as each row,
+    with a binary search in the sorted reference keys
+
+    The reference keys should be unique.  The keys can be a subset, in
+    any order
+
+    parameters
+    ----------
+    keys: array
+        The keys to look up
+    ref_keys: array
+        The reference keys
+
+    returns
+    -------
+    ind, ref_ind: arrays
+        The rows of keys that were found, and the matching rows of the
+        reference
+    """
+    keys = numpy.array(keys, ndmin=1)
+    ref_keys = numpy.array(ref_keys, ndmin=1)
+
+    if keys.size == 0 or ref_keys.size == 0:
+        empty = numpy.zeros(0, dtype='i8')
+        return empty, empty.copy()
 
-    assert numpy.all(data['number'] == matched_data['number'])
+    # the catalogs are normally already sorted
+    if numpy.all(ref_keys[1:] >= ref_keys[:-1]):
+        order = None
+        sorted_keys = ref_keys
+    else:
+        order = numpy.argsort(ref_keys, kind='mergesort')
+        sorted_keys = ref_keys[order]
 
-    add_dt=[
-        ('sxflags','i4'),
-        ('shear_true','f8',2),
-        ('shear_index','i2'),
-    ]
-    newdata = eu.numpy_util.add_fields(data, add_dt)
+    pos = numpy.searchsorted(sorted_keys, keys)
+    pos.clip(0, sorted_keys.size-1, out=pos)
 
-    newdata['sxflags']     = matched_data['flags']
-    newdata['shear_index'] = matched_data['shear_index']
-    newdata['shear_true']  = matched_data['shear_true']
+    ind, = numpy.where(sorted_keys[pos] == keys)
+    ref_ind = pos[ind]
+    if order is not None:
+        ref_ind = order[ref_ind]
 
-    return newdata
+    return ind, ref_ind
 
 
-def match_truth(data, run, index, radius=8):
+def match_truth(data, run, index, radius=8, one_to_one=False, out=None):
     """
     get the sextractor catalog, which should align with this one.
 
     match x,y to the truth catalog
 
-    copy in shear and shear_index
+    copy in shear and shear_index, as well as the match distance, number
+    of candidates within the radius and the ambiguity flags; see
+    matching.match_with_info
+
+    if one_to_one is True, each truth object is assigned to at most one
+    detection, resolving conflicts by distance
+
+    out is an optional array to fill, with the fields of data plus
+    MATCH_DT, e.g. from get_match_dtype
     """
     import nbrsim
 
@@ -43,40 +169,53 @@ def match_truth(data, run, index, radius=8):
 
     print("matching")
     print("    reading:",sx_file)
-    sx    = fitsio.read(sx_file, ext=2, lower=True)
+    sx    = fitsio.read(
+        sx_file,
+        ext=2,
+        lower=True,
+        columns=['number','xwin_image','ywin_image','flags'],
+    )
     print("    reading:",truth_file)
-    truth = fitsio.read(truth_file)
+    truth = fitsio.read(
+        truth_file,
+        columns=['x','y','shear1','shear2','shear_index'],
+    )
 
     if not numpy.all(sx['number']==data['number']):
         print("ERROR: not all numbers match")
         return None, None
     #assert numpy.all(sx['number']==data['number'])
 
-    allow=1
-    msx, mtruth = close_match(
+    info = matching.match_with_info(
         sx['xwin_image']-1,
         sx['ywin_image']-1,
         truth['x'],
         truth['y'],
         radius,
-        allow,
+        one_to_one=one_to_one,
     )
+    msx, = numpy.where(info['match_index'] >= 0)
+    mtruth = info['match_index'][msx]
 
     nmatch=msx.size
     ntot=sx.size
     frac=float(nmatch)/ntot
     print("        matched %d/%d %.2f" % (nmatch, ntot, frac))
 
-    add_dt=[
-        ('sxflags','i4'),
-        ('shear_true','f8',2),
-        ('shear_index','i2'),
-    ]
-    newdata = eu.numpy_util.add_fields(data, add_dt)
-    newdata['shear_index'] = -9999
+    if out is None:
+        newdata = numpy.zeros(data.size, dtype=get_match_dtype(data.dtype))
+    else:
+        newdata = out
+
+    eu.numpy_util.copy_fields(data, newdata)
+    newdata['shear_index'] = NO_MATCH
 
     newdata['sxflags'] = sx['flags']
 
+    newdata['match_dist'] = info['match_dist']
+    newdata['match_ncand'] = info['match_ncand']
+    newdata['match_ambig'] = info['match_ambig']
+
     if nmatch > 0:
         newdata['shear_true'][msx,0] = truth['shear1'][mtruth]
         newdata['shear_true'][msx,1] = truth['shear2'][mtruth]
@@ -106,6 +245,9 @@ def close_match(t1,s1,t2,s2,ep,allow,verbose=False):
     Translated from IDL by Eli Rykoff, SLAC
 
     modified slightly by erin sheldon
+
+    This is the original loop based version, kept for comparison;
+    see matching.close_match for the version used in matching
     """
     t1=numpy.atleast_1d(t1)
     s1=numpy.atleast_1d(s1)
@@ -208,7 +350,7 @@ def _binary_search(arr,x,edgedefault=False,round=False):
     down=-1
     up=n
     while (up-down) > 1:
-        mid=down+(up-down)/2
+        mid=down+(up-down)//2
         if x >= arr[mid]:
             down=mid
         else:
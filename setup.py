@@ -10,6 +10,9 @@ scripts=[
     'nbrmixer-collate',
     'nbrmixer-fit-m-c',
     'nbrmixer-sum-all',
+    'nbrmixer-benchmark',
+    'nbrmixer-cache',
+    'nbrmixer-merge-splits',
 ]
 
 scripts=[os.path.join('bin',s) for s in scripts]
@@ -0,0 +1,93 @@
+from __future__ import print_function
+import os
+import numpy
+from numpy.testing import assert_allclose
+import pytest
+
+from nbrmixer import chunking
+from nbrmixer import files
+
+def test_balanced_chunks_lpt():
+    # 5 and 4 start the two chunks, then each 3 goes to the lighter one
+    chunks = chunking.balanced_chunks([5, 4, 3, 3, 3], 2)
+    assert chunks == [[0, 3], [1, 2, 4]]
+
+def test_balanced_chunks_equal_costs():
+    chunks = chunking.balanced_chunks(numpy.ones(6), 3)
+    assert chunks == [[0, 3], [1, 4], [2, 5]]
+
+def test_balanced_chunks_all_indices():
+    rng = numpy.random.RandomState(8)
+    costs = rng.uniform(size=100)
+
+    chunks = chunking.balanced_chunks(costs, 7)
+    assert len(chunks) == 7
+
+    allind = sorted([i for c in chunks for i in c])
+    assert allind == list(range(costs.size))
+
+    for c in chunks:
+        assert c == sorted(c)
+    assert [c[0] for c in chunks] == sorted([c[0] for c in chunks])
+
+    # the longest processing time rule is within the largest cost of
+    # the best possible balance
+    totals = [costs[c].sum() for c in chunks]
+    assert max(totals) - min(totals) <= costs.max()
+
+def test_balanced_chunks_limits():
+    assert chunking.balanced_chunks([1, 2, 3], 10) == [[0], [1], [2]]
+    assert chunking.balanced_chunks([1, 2, 3], 0) == [[0, 1, 2]]
+    assert chunking.balanced_chunks(5.0, 2) == [[0]]
+
+def test_get_runtime(tmpdir):
+    fname = os.path.join(str(tmpdir), 'test.log')
+    with open(fname, 'w') as fobj:
+        fobj.write('0:01.00elapsed\nmore\n1:02:03elapsed 99%CPU\n')
+
+    assert chunking._get_runtime(fname) == 3600 + 2*60 + 3
+
+    assert chunking._get_runtime(fname + '.missing') is None
+
+def test_get_costs_meds(tmpdir, monkeypatch):
+    fitsio = pytest.importorskip('fitsio')
+    monkeypatch.setenv(files.BASE_DIR_KEY, str(tmpdir))
+
+    run = 'run-test'
+    nobj = [10, 50, 20, 5]
+
+    meds_files=[]
+    for i, n in enumerate(nobj):
+        fname = os.path.join(str(tmpdir), 'meds-%d.fits' % i)
+        fitsio.write(
+            fname,
+            numpy.zeros(n, dtype=[('id','i8')]),
+            extname='object_data',
+            clobber=True,
+        )
+        meds_files.append(fname)
+
+    # no outputs yet
+    for cost_type in ['size','nrows']:
+        costs = chunking.get_costs(run, 4, cost_type, meds_files=meds_files)
+        assert_allclose(costs, nobj)
+
+    # without the MEDS files all get the default
+    costs = chunking.get_costs(run, 4, 'nrows')
+    assert_allclose(costs, 1.0)
+
+    # one output, the rest scaled by its size per object
+    output_file = files.get_output_file(run, 1)
+    os.makedirs(os.path.dirname(output_file))
+    fitsio.write(output_file, numpy.zeros(50, dtype=[('x','f8',20)]))
+
+    costs = chunking.get_costs(run, 4, 'nrows', meds_files=meds_files)
+    assert_allclose(costs, nobj)
+
+    size = os.path.getsize(output_file)
+    costs = chunking.get_costs(run, 4, 'size', meds_files=meds_files)
+    assert_allclose(costs, numpy.array(nobj)*size/50.0)
+
+def test_get_costs_bad_type():
+    with pytest.raises(ValueError):
+        chunking.get_costs('run-test', 4, 'bad')
@@ -0,0 +1,173 @@
+from __future__ import print_function
+import os
+import numpy
+from numpy.testing import assert_array_equal
+import pytest
+
+fitsio = pytest.importorskip('fitsio')
+
+from nbrmixer import collate
+from nbrmixer import files
+
+RUN='run-test'
+
+class _TestCollator(collate.Collator):
+    """
+    a collator for files on disk without the nbrsim truth; the file
+    index is added and the truth columns are left zero
+    """
+    def __init__(self, njobs):
+        self.run=RUN
+        self.match=False
+        self.one_to_one=False
+        self.nproc=1
+        self.clobber=False
+        self.columnar=False
+        self.columns=None
+        self.njobs=njobs
+
+        self.collated_file = files.get_collated_file(RUN)
+        self.manifest_file = files.get_collated_manifest_file(RUN)
+        self.index_file = files.get_collated_index_file(RUN)
+        self.dtype = None
+
+    def _iter_data(self, indices):
+        for i in indices:
+            output_file = files.get_output_file(self.run, i)
+            odata = fitsio.read(output_file)
+
+            data = numpy.zeros(odata.size, dtype=self.dtype)
+            for n in odata.dtype.names:
+                data[n] = odata[n]
+            data['file_id'] = i
+
+            yield i, data
+
+@pytest.fixture
+def outdir(tmpdir, monkeypatch):
+    monkeypatch.setenv(files.BASE_DIR_KEY, str(tmpdir))
+    return str(tmpdir)
+
+def _write_output(index, nrows, version=0):
+    data = numpy.zeros(nrows, dtype=[('number','i4'),('x','f8')])
+    data['number'] = numpy.arange(1, nrows+1)
+    data['x'] = 1000*index + numpy.arange(nrows) + 0.5*version
+
+    fname = files.get_output_file(RUN, index)
+    if not os.path.exists(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+
+    fitsio.write(fname, data, clobber=True)
+
+    # make sure the change is seen even within the mtime resolution
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + version))
+    return data
+
+def _collate(njobs):
+    collator = _TestCollator(njobs)
+    collator.go()
+    return collator
+
+def _check(expected):
+    """
+    check the rows for each index in the collated file and manifest
+    """
+    import json
+
+    collated = fitsio.read(files.get_collated_file(RUN))
+    with open(files.get_collated_manifest_file(RUN)) as fobj:
+        manifest = json.load(fobj)
+
+    entries = manifest['entries']
+    assert sorted(entries, key=int) == [str(i) for i in sorted(expected)]
+    assert collated.size == sum([d.size for d in expected.values()])
+    assert manifest['nrows'] == collated.size
+
+    starts = {}
+    for i, data in expected.items():
+        entry = entries[str(i)]
+        beg = entry['row_start']
+        end = beg + entry['nrows']
+        assert entry['nrows'] == data.size
+        assert numpy.all(collated['file_id'][beg:end] == i)
+        assert_array_equal(collated['x'][beg:end], data['x'])
+        starts[i] = beg
+
+    return starts
+
+def test_collate_new(outdir):
+    expected = dict([(i, _write_output(i, n)) for i, n in [(0,5),(1,3),(2,4)]])
+    _collate(4)
+    starts = _check(expected)
+
+    # written in index order
+    assert starts == {0:0, 1:5, 2:8}
+
+def test_collate_append(outdir):
+    expected = dict([(i, _write_output(i, n)) for i, n in [(0,5),(2,4)]])
+    _collate(4)
+
+    expected[1] = _write_output(1, 3)
+    expected[3] = _write_output(3, 2)
+    collator = _collate(4)
+    starts = _check(expected)
+
+    # existing rows stay in place, new files are appended
+    assert starts[0] == 0 and starts[2] == 5
+    assert sorted([starts[1], starts[3]]) == [9, 12]
+
+    # nothing to do the second time
+    status = collator._get_status(collator._read_manifest())
+    assert status['new'] == [] and status['changed'] == []
+    assert status['repack'] is False
+
+def test_collate_rewrite_in_place(outdir):
+    expected = dict([(i, _write_output(i, n)) for i, n in [(0,5),(1,3),(2,4)]])
+    _collate(3)
+
+    expected[1] = _write_output(1, 3, version=1)
+    manifest = _TestCollator(3)._read_manifest()
+    status = _TestCollator(3)._get_status(manifest)
+    assert status['changed'] == [1]
+    assert status['repack'] is False
+
+    _collate(3)
+    starts = _check(expected)
+    assert starts == {0:0, 1:5, 2:8}
+
+def test_collate_repack_size_change(outdir):
+    expected = dict([(i, _write_output(i, n)) for i, n in [(0,5),(1,3),(2,4)]])
+    _collate(3)
+
+    expected[0] = _write_output(0, 7, version=1)
+    status = _TestCollator(3)._get_status(_TestCollator(3)._read_manifest())
+    assert status['repack'] is True
+
+    _collate(3)
+    starts = _check(expected)
+    assert starts == {0:0, 1:7, 2:10}
+
+def test_collate_repack_removed(outdir):
+    expected = dict([(i, _write_output(i, n)) for i, n in [(0,5),(1,3),(2,4)]])
+    _collate(3)
+
+    os.remove(files.get_output_file(RUN, 1))
+    del expected[1]
+
+    _collate(3)
+    starts = _check(expected)
+    assert starts == {0:0, 2:5}
+
+def test_collate_unchanged_touch(outdir):
+    expected = dict([(i, _write_output(i, n)) for i, n in [(0,5),(1,3)]])
+    _collate(2)
+
+    # a new mtime with the same content is not a change
+    fname = files.get_output_file(RUN, 1)
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + 10))
+
+    status = _TestCollator(2)._get_status(_TestCollator(2)._read_manifest())
+    assert status['unchanged'] == [0, 1]
+    assert status['repack'] is False
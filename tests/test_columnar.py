@@ -0,0 +1,75 @@
+from __future__ import print_function
+import os
+import numpy
+from numpy.testing import assert_array_equal
+import pytest
+
+fitsio = pytest.importorskip('fitsio')
+
+from nbrmixer import columnar
+from nbrmixer import files
+
+RUN='run-test'
+
+@pytest.fixture
+def collated(tmpdir, monkeypatch):
+    monkeypatch.setenv(files.BASE_DIR_KEY, str(tmpdir))
+
+    rng = numpy.random.RandomState(4)
+    data = numpy.zeros(
+        25,
+        dtype=[('number','i4'),('mcal_g','f8',2),
+               ('cov','f4',(2,2)),('file_id','i4')],
+    )
+    data['number'] = numpy.arange(data.size)
+    data['mcal_g'] = rng.normal(size=(data.size,2))
+    data['cov'] = rng.uniform(size=(data.size,2,2))
+    data['file_id'] = data['number'] // 10
+
+    fname = files.get_collated_file(RUN)
+    os.makedirs(os.path.dirname(fname))
+    fitsio.write(fname, data, clobber=True)
+    return data
+
+def test_read_round_trip(collated):
+    columnar.write_columns(RUN, chunksize=7)
+
+    store = columnar.get_store(RUN)
+    assert store is not None
+    assert store.get_nrows() == collated.size
+    assert store.get_colnames() == list(collated.dtype.names)
+
+    data = store.read()
+    assert_array_equal(data, collated)
+
+    # native byte order, whatever the FITS file had
+    for name in data.dtype.names:
+        assert data.dtype[name].base.isnative
+
+def test_read_columns_rows(collated):
+    columnar.write_columns(RUN)
+    store = columnar.get_store(RUN)
+
+    data = store.read(columns=['cov','number'], beg=5, end=13)
+    assert data.dtype.names == ('cov','number')
+    assert data.size == 8
+    assert_array_equal(data['cov'], collated['cov'][5:13])
+    assert_array_equal(data['number'], collated['number'][5:13])
+
+    data = store.read(columns=['number'], beg=20)
+    assert_array_equal(data['number'], collated['number'][20:])
+
+    data = store.read(beg=30)
+    assert data.size == 0
+
+def test_store_out_of_date(collated):
+    columnar.write_columns(RUN)
+
+    fname = files.get_collated_file(RUN)
+    st = os.stat(fname)
+    os.utime(fname, (st.st_atime, st.st_mtime + 10))
+
+    assert columnar.get_store(RUN) is None
+
+def test_no_store(collated):
+    assert columnar.get_store(RUN) is None
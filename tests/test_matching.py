@@ -0,0 +1,171 @@
+from __future__ import print_function
+import numpy
+from numpy.testing import assert_array_equal
+
+from nbrmixer import matching
+from nbrmixer import util
+
+def _make_points(seed, ntruth=2000, size=1000.0, radius=5.0):
+    rng = numpy.random.RandomState(seed)
+
+    xt = rng.uniform(low=0, high=size, size=ntruth)
+    yt = rng.uniform(low=0, high=size, size=ntruth)
+
+    ndet = int(0.8*ntruth)
+    ind = rng.randint(0, ntruth, size=ndet)
+    xd = xt[ind] + rng.normal(scale=radius/2.0, size=ndet)
+    yd = yt[ind] + rng.normal(scale=radius/2.0, size=ndet)
+
+    return xd, yd, xt, yt
+
+def _get_pairs(m1, m2):
+    return set(zip(numpy.array(m1).tolist(), numpy.array(m2).tolist()))
+
+def _compare_legacy(seed, radius, allow):
+    xd, yd, xt, yt = _make_points(seed, radius=radius)
+
+    m1, m2 = matching.close_match(xd, yd, xt, yt, radius, allow)
+    lm1, lm2 = util.close_match(xd, yd, xt, yt, radius, allow)
+
+    # m1 is sorted
+    assert numpy.all(numpy.diff(m1) >= 0)
+
+    # the legacy code never matches the truth with the lowest x, which
+    # also changes which candidates are kept for the detections near it
+    imin = xt.argmin()
+    near = (numpy.abs(xd-xt[imin]) < radius) & (numpy.abs(yd-yt[imin]) < radius)
+    skip = set(numpy.where(near)[0].tolist())
+
+    pairs = set(p for p in _get_pairs(m1, m2) if p[0] not in skip)
+    lpairs = set(p for p in _get_pairs(lm1, lm2) if p[0] not in skip)
+
+    assert len(pairs) > 0
+    assert pairs == lpairs
+
+def test_close_match_legacy_allow1():
+    for seed in range(3):
+        _compare_legacy(seed, 5.0, 1)
+
+def test_close_match_legacy_allow3():
+    for seed in range(3):
+        _compare_legacy(seed, 8.0, 3)
+
+def test_close_match_lowest_x():
+    x2 = numpy.array([10.0, 0.0, 50.0])
+    y2 = numpy.array([10.0, 0.0, 50.0])
+
+    x1 = numpy.array([0.5])
+    y1 = numpy.array([0.5])
+
+    m1, m2 = matching.close_match(x1, y1, x2, y2, 2.0, 1)
+    assert_array_equal(m1, [0])
+    assert_array_equal(m2, [1])
+
+    # the documented difference from the legacy code
+    lm1, lm2 = util.close_match(x1, y1, x2, y2, 2.0, 1)
+    assert lm1.size == 0
+
+def test_close_match_nearest():
+    x2 = numpy.array([0.0, 1.0, 3.0, 4.5])
+    y2 = numpy.zeros(4)
+
+    m1, m2 = matching.close_match([2.9], [0.0], x2, y2, 5.0, 2)
+    assert_array_equal(m1, [0, 0])
+    assert_array_equal(m2, [2, 3])
+
+def test_close_match_box():
+    # a pair is a candidate if both |dx| and |dy| are within the radius
+    m1, m2 = matching.close_match([0.0], [0.0], [0.9, 1.1], [0.9, 0.0], 1.0, 2)
+    assert_array_equal(m2, [0])
+
+def test_close_match_batches():
+    xd, yd, xt, yt = _make_points(5)
+
+    m1, m2 = matching.close_match(xd, yd, xt, yt, 5.0, 2)
+    bm1, bm2 = matching.close_match(xd, yd, xt, yt, 5.0, 2, batchsize=10)
+
+    assert_array_equal(m1, bm1)
+    assert_array_equal(m2, bm2)
+
+def test_close_match_empty():
+    m1, m2 = matching.close_match([0.0], [0.0], [100.0], [100.0], 1.0, 1)
+    assert m1.size == 0 and m2.size == 0
+
+    m1, m2 = matching.close_match([], [], [100.0], [100.0], 1.0, 1)
+    assert m1.size == 0 and m2.size == 0
+
+def _greedy_one_to_one(m1, m2, dist):
+    """
+    accept pairs one at a time in order of distance, ties broken by
+    position
+    """
+    used1=set()
+    used2=set()
+    keep=[]
+    for i in numpy.lexsort( (numpy.arange(m1.size), dist) ):
+        if m1[i] in used1 or m2[i] in used2:
+            continue
+        used1.add(m1[i])
+        used2.add(m2[i])
+        keep.append(i)
+
+    keep = numpy.array(keep, dtype='i8')
+    s = m1[keep].argsort()
+    return m1[keep][s], m2[keep][s], dist[keep][s]
+
+def test_assign_one_to_one_greedy():
+    for seed in range(5):
+        xd, yd, xt, yt = _make_points(seed, ntruth=500, size=200.0)
+
+        m1, m2, dist, ncand = matching._get_pairs(xd, yd, xt, yt, 5.0)
+        am1, am2, adist = matching._assign_one_to_one(m1, m2, dist)
+        gm1, gm2, gdist = _greedy_one_to_one(m1, m2, dist)
+
+        assert_array_equal(am1, gm1)
+        assert_array_equal(am2, gm2)
+        assert_array_equal(adist, gdist)
+
+        assert numpy.unique(am1).size == am1.size
+        assert numpy.unique(am2).size == am2.size
+
+def test_assign_one_to_one_ties():
+    # equal distances are broken by the pair order
+    m1 = numpy.array([0, 0, 1, 1])
+    m2 = numpy.array([0, 1, 0, 1])
+    dist = numpy.ones(4)
+
+    am1, am2, adist = matching._assign_one_to_one(m1, m2, dist)
+    gm1, gm2, gdist = _greedy_one_to_one(m1, m2, dist)
+
+    assert_array_equal(am1, gm1)
+    assert_array_equal(am2, gm2)
+
+def test_match_with_info():
+    # both detections are nearest to truth 0; the second loses it in
+    # one-to-one mode and falls back to truth 1
+    x1 = numpy.array([0.0, 0.5])
+    y1 = numpy.zeros(2)
+    x2 = numpy.array([0.1, 1.5])
+    y2 = numpy.zeros(2)
+
+    info = matching.match_with_info(x1, y1, x2, y2, 2.0)
+    assert_array_equal(info['match_index'], [0, 0])
+    assert_array_equal(info['match_ncand'], [2, 2])
+    assert numpy.all(info['match_ambig'] & matching.AMBIG_MULTI)
+    assert numpy.all(info['match_ambig'] & matching.AMBIG_SHARED)
+
+    info = matching.match_with_info(x1, y1, x2, y2, 2.0, one_to_one=True)
+    assert_array_equal(info['match_index'], [0, 1])
+    numpy.testing.assert_allclose(info['match_dist'], [0.1, 1.0])
+
+def test_match_with_info_lost():
+    x1 = numpy.array([0.0, 0.5])
+    y1 = numpy.zeros(2)
+    x2 = numpy.array([0.1])
+    y2 = numpy.zeros(1)
+
+    info = matching.match_with_info(x1, y1, x2, y2, 2.0, one_to_one=True)
+    assert_array_equal(info['match_index'], [0, -1])
+    assert info['match_dist'][1] == -9999.0
+    assert info['match_ambig'][1] & matching.AMBIG_LOST
+    assert not info['match_ambig'][0] & matching.AMBIG_LOST
@@ -0,0 +1,10 @@
+from __future__ import print_function
+
+from nbrmixer import scripts
+
+def test_get_array_spec():
+    assert scripts.get_array_spec([1]) == '1'
+    assert scripts.get_array_spec([1,2,3,4,5]) == '1-5'
+    assert scripts.get_array_spec([1,2,3,4,5,9,12,13,14]) == '1-5,9,12-14'
+    assert scripts.get_array_spec([2,4,6]) == '2,4,6'
+    assert scripts.get_array_spec([1,3,4]) == '1,3-4'
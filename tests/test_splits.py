@@ -0,0 +1,78 @@
+from __future__ import print_function
+import os
+import numpy
+from numpy.testing import assert_array_equal
+import pytest
+
+from nbrmixer import splits
+from nbrmixer import files
+
+def test_get_split_ranges():
+    assert splits.get_split_ranges(10, 4) == [(0,3), (4,7), (8,9)]
+    assert splits.get_split_ranges(8, 4) == [(0,3), (4,7)]
+    assert splits.get_split_ranges(3, 10) == [(0,2)]
+    assert splits.get_split_ranges(1, 1) == [(0,0)]
+    assert splits.get_split_ranges(0, 5) == []
+
+def test_get_split_ranges_cover():
+    for nfof in [1, 7, 100, 101]:
+        for split_size in [1, 3, 10, 200]:
+            ranges = splits.get_split_ranges(nfof, split_size)
+            ind = numpy.concatenate(
+                [numpy.arange(start, end+1) for start, end in ranges]
+            )
+            assert_array_equal(ind, numpy.arange(nfof))
+            assert all(end-start+1 <= split_size for start, end in ranges)
+
+def test_get_split_ranges_bad():
+    with pytest.raises(ValueError):
+        splits.get_split_ranges(10, 0)
+
+def test_merge_splits(tmpdir, monkeypatch):
+    fitsio = pytest.importorskip('fitsio')
+    monkeypatch.setenv(files.BASE_DIR_KEY, str(tmpdir))
+
+    run = 'run-test'
+    nsplit = 3
+
+    tables=[]
+    for split in range(nsplit):
+        fname = files.get_split_output_file(run, 0, split)
+        if not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+
+        table = numpy.zeros(split+2, dtype=[('id','i8'),('x','f4',2)])
+        table['id'] = split
+        tables.append(table)
+
+        with fitsio.FITS(fname, 'rw', clobber=True, ignore_empty=True) as fits:
+            fits.write(None)
+            fits[0].write_keys([{'name':'PKEY', 'value':split}])
+            fits.write(table, extname='model_fits', header={'TKEY':1})
+            fits.write(None, extname='empty', header={'EKEY':2})
+            fits.write(numpy.ones((2,3)), extname='image')
+
+    splits.merge_splits(run, 0, nsplit)
+
+    for split in range(nsplit):
+        assert not os.path.exists(files.get_split_output_file(run, 0, split))
+
+    with fitsio.FITS(files.get_output_file(run, 0)) as fits:
+        assert len(fits) == 4
+
+        assert not fits[0].has_data()
+        assert fits[0].read_header()['PKEY'] == 0
+
+        assert_array_equal(fits['model_fits'].read(), numpy.concatenate(tables))
+        assert fits['model_fits'].read_header()['TKEY'] == 1
+
+        assert fits['empty'].get_exttype() == 'IMAGE_HDU'
+        assert not fits['empty'].has_data()
+        assert fits['empty'].read_header()['EKEY'] == 2
+
+        assert_array_equal(fits['image'].read(), numpy.ones((2,3)))
+
+def test_merge_splits_missing(tmpdir, monkeypatch):
+    monkeypatch.setenv(files.BASE_DIR_KEY, str(tmpdir))
+    with pytest.raises(IOError):
+        splits.merge_splits('run-test', 0, 2)
@@ -0,0 +1,95 @@
+from __future__ import print_function
+import os
+import numpy
+from numpy.testing import assert_array_equal
+import pytest
+
+from nbrmixer import sums
+
+def _make_sums(seed, dtype=None):
+    if dtype is None:
+        dtype=[('wsum','f8'),('g','f8',2),('npsf','i8',(2,2))]
+
+    rng = numpy.random.RandomState(seed)
+    data = numpy.zeros(3, dtype=dtype)
+    for n in data.dtype.names:
+        data[n] = rng.uniform(size=data[n].shape)*100
+
+    return data
+
+def test_add_sums():
+    s1 = _make_sums(1)
+    s2 = _make_sums(2)
+
+    res = sums.add_sums(s1.copy(), s2)
+    for n in s1.dtype.names:
+        assert_array_equal(res[n], s1[n] + s2[n])
+
+def test_add_sums_none():
+    s1 = _make_sums(1)
+    res = sums.add_sums(None, s1)
+    assert res is not s1
+    assert_array_equal(res, s1)
+
+def test_add_sums_byte_order():
+    s1 = _make_sums(1)
+    s2 = _make_sums(2)
+
+    s1big = s1.astype(s1.dtype.newbyteorder('>'))
+
+    res = sums.add_sums(s1big.copy(), s2)
+    for n in s1.dtype.names:
+        assert_array_equal(res[n], s1[n] + s2[n])
+
+    res = sums.add_sums(s2.copy(), s1big)
+    for n in s1.dtype.names:
+        assert_array_equal(res[n], s1[n] + s2[n])
+
+def test_add_sums_fits_round_trip(tmpdir):
+    fitsio = pytest.importorskip('fitsio')
+
+    s1 = _make_sums(1)
+    s2 = _make_sums(2)
+
+    fname = os.path.join(str(tmpdir), 'sums.fits')
+    fitsio.write(fname, s1, clobber=True)
+
+    res = sums.add_sums(fitsio.read(fname).copy(), s2)
+    for n in s1.dtype.names:
+        assert_array_equal(res[n], s1[n] + s2[n])
+
+def test_add_sums_mismatch():
+    s1 = _make_sums(1)
+
+    s2 = _make_sums(2, dtype=[('wsum','f8'),('g','f8',2)])
+    with pytest.raises(ValueError):
+        sums.add_sums(s1.copy(), s2)
+
+    with pytest.raises(ValueError):
+        sums.add_sums(s1.copy(), s1[:2])
+
+def test_tree_sum():
+    sums_list = [_make_sums(seed) for seed in range(7)]
+
+    res = sums.tree_sum(sums_list)
+
+    expected = sums_list[0].copy()
+    for s in sums_list[1:]:
+        for n in expected.dtype.names:
+            expected[n] += s[n]
+
+    for n in expected.dtype.names:
+        numpy.testing.assert_allclose(res[n], expected[n])
+
+    # the inputs are not modified
+    assert_array_equal(sums_list[0], _make_sums(0))
+
+def test_tree_sum_single():
+    s1 = _make_sums(1)
+    res = sums.tree_sum([s1])
+    assert res is not s1
+    assert_array_equal(res, s1)
+
+def test_tree_sum_empty():
+    with pytest.raises(ValueError):
+        sums.tree_sum([])
@@ -0,0 +1,80 @@
+from __future__ import print_function
+import os
+import sys
+import types
+import numpy
+from numpy.testing import assert_array_equal
+import pytest
+
+from nbrmixer import util
+
+def test_join_sorted():
+    ref = numpy.array([1, 3, 5, 7, 9])
+    keys = numpy.array([9, 4, 1, 7, 10, 0])
+
+    ind, ref_ind = util.join_sorted(keys, ref)
+    assert_array_equal(ind, [0, 2, 3])
+    assert_array_equal(ref[ref_ind], keys[ind])
+
+def test_join_sorted_unsorted_ref():
+    rng = numpy.random.RandomState(2)
+    ref = rng.permutation(100)*2
+    keys = rng.permutation(150)
+
+    ind, ref_ind = util.join_sorted(keys, ref)
+    assert_array_equal(ref[ref_ind], keys[ind])
+
+    expected, = numpy.where( (keys % 2 == 0) & (keys < 200) )
+    assert_array_equal(ind, expected)
+
+def test_join_sorted_empty():
+    ind, ref_ind = util.join_sorted([], [1, 2])
+    assert ind.size == 0 and ref_ind.size == 0
+
+    ind, ref_ind = util.join_sorted([1, 2], [])
+    assert ind.size == 0 and ref_ind.size == 0
+
+def test_add_true_shear(tmpdir, monkeypatch):
+    fitsio = pytest.importorskip('fitsio')
+
+    match_file = os.path.join(str(tmpdir), 'match.fits')
+
+    # the sxcat match catalog, with a row missing and in reverse order
+    nobj = 10
+    matched = numpy.zeros(
+        nobj,
+        dtype=[('number','i4'),('flags','i4'),
+               ('shear_index','i2'),('shear_true','f8',2)],
+    )
+    matched['number'] = numpy.arange(1, nobj+1)
+    matched['flags'] = matched['number'] % 3
+    matched['shear_index'] = matched['number'] % 4
+    matched['shear_true'][:,0] = 0.01*matched['number']
+    matched = matched[::-1]
+    matched = matched[matched['number'] != 4]
+    fitsio.write(match_file, matched, clobber=True)
+
+    # only the files module of nbrsim is used, to find the catalog
+    nbrsim = types.ModuleType('nbrsim')
+    nbrsim.files = types.ModuleType('nbrsim.files')
+    nbrsim.files.get_sxcat_match_file = lambda run, index: match_file
+    monkeypatch.setitem(sys.modules, 'nbrsim', nbrsim)
+
+    data = numpy.zeros(5, dtype=[('number','i4'),('x','f8')])
+    data['number'] = [7, 4, 1, 10, 3]
+    data['x'] = numpy.arange(5)
+
+    out = util.add_true_shear(data, 'sim-test', 0)
+
+    assert_array_equal(out['number'], data['number'])
+    assert_array_equal(out['x'], data['x'])
+
+    found = out['number'] != 4
+    num = out['number'][found]
+    assert_array_equal(out['sxflags'][found], num % 3)
+    assert_array_equal(out['shear_index'][found], num % 4)
+    assert_array_equal(out['shear_true'][found,0], 0.01*num)
+
+    assert out['sxflags'][1] == util.NO_MATCH
+    assert out['shear_index'][1] == util.NO_MATCH
+    assert numpy.all(out['shear_true'][1] == util.NO_MATCH)